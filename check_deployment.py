@@ -1,95 +1,328 @@
-#!/usr/bin/env python3
+#!/usr/bin/env -S python3 -I
 """
 NeoChat Render Deployment Checker
 Проверяет готовность проекта к развёртыванию на Render
+
+Запускается в изолированном режиме (python3 -I): без PYTHON* переменных
+окружения и пользовательского site-packages. Флаг -S не используется -
+без site не найти метаданные установленных пакетов и PyYAML.
 """
 
+import argparse
+import json
+import mmap
 import os
+import re
+import stat
 import sys
-import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from importlib.metadata import PackageNotFoundError, version
+
+try:
+    import yaml
+    _YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+except ImportError:
+    yaml = None
+
+# Файлы крупнее страницы отображаются в память вместо чтения целиком
+MMAP_THRESHOLD = 4096
+
+# Значки статуса, индексируются результатом проверки (False/True)
+_STATUS = ("❌", "✅")
+_CONTENT_STATUS = ("⚠️", "✅")
+
+# Тексты ошибок для результатов с полем "error"
+_ERRORS = {
+    "not_found": "файл не найден",
+    "invalid_yaml": "некорректный YAML",
+}
+
+# Результаты прошлых запусков: {путь: {"stat": [mtime_ns, size], "found": {фрагмент: bool}}}
+CACHE_FILE = ".check_deployment.cache.json"
+_result_cache = {}
+
+# Обязательные файлы: (путь, описание)
+FILE_CHECKS = (
+    ("render.yaml", "Render конфигурация"),
+    ("requirements.txt", "Python зависимости"),
+    ("runtime.txt", "Python версия"),
+    ("websocket_server.py", "WebSocket сервер"),
+    (".gitignore", "Git ignore файл"),
+)
+
+# Ожидаемое содержимое: (путь, ((фрагмент, описание), ...))
+CONTENT_CHECKS = (
+    ("requirements.txt", (
+        ("websockets", "websockets в requirements.txt"),
+        ("aiohttp", "aiohttp в requirements.txt"),
+    )),
+    ("render.yaml", (
+        ("websocket_server.py", "startCommand в render.yaml"),
+    )),
+    ("websocket_server.py", (
+        ("os.environ.get(\"PORT\"", "PORT из переменных окружения"),
+        ("0.0.0.0", "Host 0.0.0.0"),
+    )),
+)
+
+def load_cache():
+    """Загружает результаты предыдущего запуска, если они есть"""
+    try:
+        with open(CACHE_FILE, 'r', encoding='utf-8') as f:
+            _result_cache.update(json.load(f))
+    except (OSError, ValueError):
+        pass
+
+def save_cache():
+    """Сохраняет результаты для следующего запуска"""
+    try:
+        with open(CACHE_FILE, 'w', encoding='utf-8') as f:
+            json.dump(_result_cache, f)
+    except OSError:
+        pass
+
+def _read_file(filepath):
+    """Читает файл с диска.
+
+    Большие файлы возвращаются как mmap: ядро подгружает только те страницы,
+    которые реально просматривает поиск.
+    """
+    with open(filepath, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < MMAP_THRESHOLD:
+            return f.read()
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+@lru_cache(maxsize=None)
+def _needles_pattern(needles):
+    """Одна регулярка-альтернация для всех фрагментов файла"""
+    return re.compile(b"|".join(re.escape(needle) for needle in needles))
+
+def _find_needles(file_content, needles):
+    """Ищет все фрагменты за один проход по содержимому файла"""
+    found = {m.group() for m in _needles_pattern(needles).finditer(file_content)}
+    # finditer не возвращает перекрывающиеся совпадения - такие фрагменты
+    # добираем отдельным поиском
+    for needle in needles:
+        if needle not in found and file_content.find(needle) != -1:
+            found.add(needle)
+    return found
+
+@lru_cache(maxsize=None)
+def _root_files():
+    """Имена файлов в корне проекта, собранные одним чтением каталога"""
+    with os.scandir(".") as entries:
+        return frozenset(entry.name for entry in entries if entry.is_file())
 
 def check_file(filepath, description):
     """Проверяет наличие файла"""
-    exists = os.path.isfile(filepath)
-    status = "✅" if exists else "❌"
-    print(f"{status} {description}: {filepath}")
-    return exists
-
-def check_content(filepath, content, description):
-    """Проверяет наличие содержимого в файле"""
-    if not os.path.isfile(filepath):
-        print(f"❌ {description}: файл не найден")
-        return False
-    
-    with open(filepath, 'r', encoding='utf-8') as f:
-        file_content = f.read()
-        exists = content in file_content
-        status = "✅" if exists else "⚠️"
-        print(f"{status} {description}")
-        return exists
+    if not os.path.dirname(filepath):
+        exists = filepath in _root_files()
+    else:
+        try:
+            exists = stat.S_ISREG(os.stat(filepath).st_mode)
+        except OSError:
+            exists = False
+    return {"ok": exists, "desc": description, "path": filepath}
+
+def check_contents(filepath, checks):
+    """Проверяет наличие нескольких фрагментов в файле за одно чтение.
+
+    Если файл не менялся с прошлого запуска (mtime и размер совпадают),
+    результаты берутся из кэша без чтения файла.
+    """
+    try:
+        st = os.stat(filepath)
+        signature = [st.st_mtime_ns, st.st_size]
+        entry = _result_cache.get(filepath)
+        if entry and entry["stat"] == signature and all(c in entry["found"] for c, _ in checks):
+            found = entry["found"]
+        else:
+            needles = tuple(content.encode('utf-8') for content, _ in checks)
+            matched = _find_needles(_read_file(filepath), needles)
+            found = {content: needle in matched for (content, _), needle in zip(checks, needles)}
+            _result_cache[filepath] = {"stat": signature, "found": found}
+    except (FileNotFoundError, IsADirectoryError):
+        return [{"ok": False, "desc": description, "path": filepath, "error": "not_found"}
+                for _, description in checks]
+
+    return [{"ok": found[content], "desc": description, "path": filepath}
+            for content, description in checks]
+
+@lru_cache(maxsize=None)
+def _load_yaml(filepath, mtime_ns):
+    """Разбирает YAML-файл; mtime_ns в ключе кэша сбрасывает его при изменении файла"""
+    with open(filepath, 'rb') as f:
+        return yaml.load(f, Loader=_YAML_LOADER)
+
+def check_render_config(filepath, checks):
+    """Проверяет startCommand сервисов в render.yaml по структуре, а не подстрокой.
+
+    Подстрока может найтись и в комментарии; без PyYAML используется
+    обычная проверка содержимого.
+    """
+    if yaml is None:
+        return check_contents(filepath, checks)
+    try:
+        config = _load_yaml(filepath, os.stat(filepath).st_mtime_ns)
+    except (FileNotFoundError, IsADirectoryError):
+        return [{"ok": False, "desc": description, "path": filepath, "error": "not_found"}
+                for _, description in checks]
+    except yaml.YAMLError:
+        return [{"ok": False, "desc": description, "path": filepath, "error": "invalid_yaml"}
+                for _, description in checks]
+
+    services = (config.get("services") or []) if isinstance(config, dict) else []
+    commands = [str(service.get("startCommand", "")) for service in services if isinstance(service, dict)]
+    return [{"ok": any(content in command for command in commands), "desc": description, "path": filepath}
+            for content, description in checks]
+
+# Файлы, содержимое которых проверяется по структуре, а не поиском подстроки
+STRUCTURED_CHECKS = {
+    "render.yaml": check_render_config,
+}
+
+def _pkg_version(name):
+    """Версия пакета из метаданных дистрибутива, без импорта самого пакета"""
+    try:
+        return version(name)
+    except PackageNotFoundError:
+        return None
 
 def check_python_packages():
     """Проверяет установленные пакеты"""
+    return [{"name": name, "version": _pkg_version(name)} for name in ("websockets", "aiohttp")]
+
+def _run_check(task):
+    func, *args = task
+    return func(*args)
+
+def _run_fail_fast(file_tasks, content_tasks):
+    """Выполняет проверки по очереди и останавливается на первой неудачной"""
+    file_results, content_results = [], []
+    for task in file_tasks:
+        result = _run_check(task)
+        file_results.append(result)
+        if not result["ok"]:
+            return file_results, content_results
+    for task in content_tasks:
+        results = _run_check(task)
+        content_results.extend(results)
+        if not all(r["ok"] for r in results):
+            break
+    return file_results, content_results
+
+def _format_file(result):
+    return f"{_STATUS[result['ok']]} {result['desc']}: {result['path']}"
+
+def _format_content(result):
+    if result.get("error"):
+        return f"❌ {result['desc']}: {_ERRORS[result['error']]}"
+    return f"{_CONTENT_STATUS[result['ok']]} {result['desc']}"
+
+def _format_package(package):
+    if package["version"]:
+        return f"✅ {package['name']} установлен: {package['version']}"
+    return f"❌ {package['name']}: не установлен"
+
+def _write_stdout(text):
+    """Выводит текст одним заранее закодированным буфером прямо в fd 1"""
+    buf = memoryview(text.encode('utf-8'))
     try:
-        import websockets
-        print(f"✅ websockets установлен: {websockets.__version__}")
-    except ImportError:
-        print(f"❌ websockets: не установлен")
-    
-    try:
-        import aiohttp
-        print(f"✅ aiohttp установлен: {aiohttp.__version__}")
-    except ImportError:
-        print(f"❌ aiohttp: не установлен")
-
-def main():
-    print("=" * 60)
-    print("🔍 NeoChat Deployment Readiness Check")
-    print("=" * 60)
-    print()
-    
-    all_ok = True
+        while buf:
+            buf = buf[os.write(1, buf):]
+    except BlockingIOError:
+        sys.stdout.buffer.write(buf)
+        sys.stdout.flush()
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Проверка готовности NeoChat к развёртыванию на Render")
+    parser.add_argument("--json", action="store_true",
+                        help="вывести результаты одной JSON-строкой вместо отчёта")
+    parser.add_argument("--fail-fast", action="store_true",
+                        help="остановиться на первой неудачной проверке")
+    parser.add_argument("--check-local-packages", action=argparse.BooleanOptionalAction, default=True,
+                        help="проверить локально установленные пакеты (необязательно, "
+                             "на готовность к развёртыванию не влияет)")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    load_cache()
     
+    # Один scandir до запуска потоков вместо stat на каждый файл; список
+    # прошлого вызова main() мог устареть
+    _root_files.cache_clear()
+    _root_files()
+    file_tasks = [(check_file, *spec) for spec in FILE_CHECKS]
+    content_tasks = [(STRUCTURED_CHECKS.get(path, check_contents), path, checks)
+                     for path, checks in CONTENT_CHECKS]
+
+    if args.fail_fast:
+        file_results, content_results = _run_fail_fast(file_tasks, content_tasks)
+        packages = check_python_packages() if args.check_local_packages else None
+    else:
+        # Все проверки независимы и упираются в I/O - запускаем их параллельно,
+        # а результаты выводим в исходном порядке
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            packages_future = executor.submit(check_python_packages) if args.check_local_packages else None
+            file_results = list(executor.map(_run_check, file_tasks))
+            content_results = [r for results in executor.map(_run_check, content_tasks) for r in results]
+            packages = packages_future.result() if packages_future else None
+    save_cache()
+
+    all_ok = all(r["ok"] for r in file_results) and all(r["ok"] for r in content_results)
+
+    if args.json:
+        _write_stdout(json.dumps({
+            "all_ok": all_ok,
+            "checks": file_results + content_results,
+            "packages": packages,
+        }, ensure_ascii=False) + "\n")
+        return 0 if all_ok else 1
+
+    # Строки отчёта копятся локально и выводятся одним вызовом в конце
+    output = []
+    output.append("=" * 60)
+    output.append("🔍 NeoChat Deployment Readiness Check")
+    output.append("=" * 60)
+    output.append("")
+
     # Проверка файлов конфигурации
-    print("📋 Проверка файлов конфигурации:")
-    all_ok &= check_file("render.yaml", "Render конфигурация")
-    all_ok &= check_file("requirements.txt", "Python зависимости")
-    all_ok &= check_file("runtime.txt", "Python версия")
-    all_ok &= check_file("websocket_server.py", "WebSocket сервер")
-    all_ok &= check_file(".gitignore", "Git ignore файл")
-    print()
+    output.append("📋 Проверка файлов конфигурации:")
+    output.extend(_format_file(r) for r in file_results)
+    output.append("")
     
     # Проверка содержимого
-    print("📝 Проверка содержимого конфигурации:")
-    all_ok &= check_content("requirements.txt", "websockets", "websockets в requirements.txt")
-    all_ok &= check_content("requirements.txt", "aiohttp", "aiohttp в requirements.txt")
-    all_ok &= check_content("render.yaml", "websocket_server.py", "startCommand в render.yaml")
-    all_ok &= check_content("websocket_server.py", "os.environ.get(\"PORT\"", "PORT из переменных окружения")
-    all_ok &= check_content("websocket_server.py", "0.0.0.0", "Host 0.0.0.0")
-    print()
+    output.append("📝 Проверка содержимого конфигурации:")
+    output.extend(_format_content(r) for r in content_results)
+    output.append("")
     
     # Проверка Python пакетов
-    print("📦 Проверка установленных пакетов (локально):")
-    check_python_packages()
-    print()
+    if packages is not None:
+        output.append("📦 Проверка установленных пакетов (локально):")
+        output.extend(_format_package(p) for p in packages)
+        output.append("")
     
     # Финальный результат
-    print("=" * 60)
+    output.append("=" * 60)
     if all_ok:
-        print("✅ Проект готов к развёртыванию на Render!")
-        print()
-        print("Следующие шаги:")
-        print("1. Загрузите код на GitHub")
-        print("2. На render.com создайте новый Web Service")
-        print("3. Свяжите репозиторий GitHub")
-        print("4. Используйте URL вашего сервера в клиенте")
-        print()
-        print(f"📌 URL сервера: https://neochat-server-b1jq.onrender.com")
-        print(f"🔗 WebSocket URL: wss://neochat-server-b1jq.onrender.com")
-        return 0
+        output.append("✅ Проект готов к развёртыванию на Render!")
+        output.append("")
+        output.append("Следующие шаги:")
+        output.append("1. Загрузите код на GitHub")
+        output.append("2. На render.com создайте новый Web Service")
+        output.append("3. Свяжите репозиторий GitHub")
+        output.append("4. Используйте URL вашего сервера в клиенте")
+        output.append("")
+        output.append(f"📌 URL сервера: https://neochat-server-b1jq.onrender.com")
+        output.append(f"🔗 WebSocket URL: wss://neochat-server-b1jq.onrender.com")
     else:
-        print("⚠️  Найдены проблемы. Пожалуйста, исправьте их перед развёртыванием.")
-        return 1
+        output.append("⚠️  Найдены проблемы. Пожалуйста, исправьте их перед развёртыванием.")
+
+    # Весь отчёт выводится одной записью в stdout
+    _write_stdout("\n".join(output) + "\n")
+    return 0 if all_ok else 1
 
 if __name__ == "__main__":
     sys.exit(main())
@@ -23,16 +23,13 @@ if errorlevel 1 (
 
 echo [+] Python найден
 
-REM Проверка websockets
-pip list | find "websockets" >nul 2>&1
+REM Установка зависимостей (websockets, orjson и др.)
+echo [*] Установка зависимостей из requirements.txt...
+pip install -r "%~dp0requirements.txt"
 if errorlevel 1 (
-    echo [*] Установка websockets...
-    pip install websockets
-    if errorlevel 1 (
-        echo [!] Ошибка при установке websockets
-        pause
-        exit /b 1
-    )
+    echo [!] Ошибка при установке зависимостей
+    pause
+    exit /b 1
 )
 
 echo [+] Зависимости установлены
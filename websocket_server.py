@@ -1,40 +1,318 @@
 import asyncio
-import json
+import orjson
 import websockets
 import re
 import sqlite3
 import html
 import time
 import hashlib
+import base64
+import hmac
 import os
 import secrets
+import functools
+import logging
+import queue
 import threading
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
 from datetime import datetime, timedelta
-from collections import defaultdict
-from http.server import HTTPServer, SimpleHTTPRequestHandler
+from collections import defaultdict, deque
+from logging.handlers import QueueHandler, QueueListener
+
+# uvloop (libuv) быстрее стандартного цикла asyncio; под Windows его нет
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+# Hyperscan проверяет стоп-слова одним DFA-проходом; есть только под Linux x86_64
+try:
+    import hyperscan
+except ImportError:
+    hyperscan = None
+
+log = logging.getLogger("neochat")
 
 # --- КОНФИГУРАЦИЯ ---
 DB_NAME = "chat_v10_ultimate.db"
 MAX_MEDIA_SIZE = 20 * 1024 * 1024  # 20 MB
 NICK_RE = re.compile(r"^[A-Za-z0-9_\-]{3,20}$")
 
+# Вложения лежат в MEDIA_DIR под своим sha256, в БД хранится только "file:<хэш>";
+# клиент забирает их по HTTP с того же порта: /media/<хэш>
+MEDIA_DIR = "media"
+MEDIA_TYPES = ("image", "video", "audio", "file")
+# Типы, которые сохраняются как сообщения (ChatServer.on_message)
+MESSAGE_TYPES = ("msg", "poll", "sticker") + MEDIA_TYPES
+MEDIA_PREFIX = "file:"
+MEDIA_PATH_RE = re.compile(r"^/media/([0-9a-f]{64})$")
+
+# Файлы клиента, которые сервер отдаёт сам: {путь запроса: (файл, Content-Type)}
+STATIC_FILES = {
+    "/": ("index.html", "text/html; charset=utf-8"),
+    "/index.html": ("index.html", "text/html; charset=utf-8"),
+    "/service-worker.js": ("service-worker.js", "application/javascript"),
+}
+
+# Сколько профилей пользователей держать в памяти
+USER_CACHE_SIZE = 4096
+
+# Сколько ролей (комната, пользователь) держать в памяти
+ROLE_CACHE_SIZE = 16384
+
+# Потоки с read-only соединениями для тяжёлых выборок (история, поиск)
+READER_THREADS = 4
+
+# Период фиксации накопленных изменений в БД, секунд
+COMMIT_INTERVAL = 0.02
+
+# Как долго планировщик спит, если запланированных сообщений нет, секунд
+SCHEDULER_IDLE = 60
+
+# Сколько кадров может ждать отправки одному клиенту; клиент, который не
+# успевает читать, сверх этого отключается (см. send_frame)
+SEND_QUEUE_SIZE = 256
+
+# Изменения присутствия за это время уходят одной рассылкой, секунд
+PRESENCE_DELAY = 0.2
+
+# Ограничение неудачных попыток входа с одного IP
+AUTH_LIMIT = 5  # попыток
+AUTH_WINDOW = 60  # секунд
+AUTH_FAIL_DELAY = 0.5  # задержка ответа на неудачную попытку, секунд
+
+# Сколько хэшей scrypt (по 16 МБ памяти каждый) считается одновременно
+HASH_CONCURRENCY = 2
+
+# Сервер за обратным прокси (Render): адрес клиента берётся из последней
+# записи X-Forwarded-For, которую добавил прокси. Без прокси заголовок
+# подделывается клиентом, поэтому по умолчанию не учитывается
+TRUST_PROXY = os.environ.get("TRUST_PROXY") == "1"
+
 # Анти-спам
-SPAM_LIMIT = 10  # сообщений в минуту
+SPAM_LIMIT = 10  # сообщений в минуту в среднем
 SPAM_WINDOW = 60  # секунд
 
+# Корзина токенов анти-спама в целых числах: каждая наносекунда добавляет
+# SPAM_LIMIT единиц, сообщение стоит SPAM_COST
+SPAM_COST = SPAM_WINDOW * 1_000_000_000
+SPAM_CAPACITY = SPAM_LIMIT * SPAM_COST
+
 # Стоп-слова для автомодерации
 BLOCKED_WORDS = ["ban", "spam", "abuse"]  # пример
+# Все стоп-слова одной регуляркой: один проход по тексту без lower()
+BLOCKED_RE = re.compile("|".join(map(re.escape, BLOCKED_WORDS)), re.IGNORECASE)
+
+def _compile_blocked():
+    """База Hyperscan для стоп-слов; без hyperscan - None, работает BLOCKED_RE"""
+    if hyperscan is None:
+        return None
+    database = hyperscan.Database(mode=hyperscan.HS_MODE_BLOCK)
+    # UTF8 + UCP: регистр не учитывается и для кириллицы, как в re.IGNORECASE
+    flags = hyperscan.HS_FLAG_CASELESS | hyperscan.HS_FLAG_UTF8 | hyperscan.HS_FLAG_UCP | hyperscan.HS_FLAG_SINGLEMATCH
+    database.compile(
+        expressions=[re.escape(word).encode() for word in BLOCKED_WORDS],
+        ids=list(range(len(BLOCKED_WORDS))),
+        flags=[flags] * len(BLOCKED_WORDS),
+    )
+    return database
+
+BLOCKED_HS = _compile_blocked()
+
+def _stop_scan(*args):
+    """Обработчик совпадения: первого найденного стоп-слова достаточно"""
+    return True
+
+# Предельная длина bio/статуса и названия группы; обрезается до экранирования
+BIO_MAX_LEN = 256
+ROOM_NAME_MAX_LEN = 64
+
+# Предельная длина реакции; реакции с символами разметки не принимаются
+EMOJI_MAX_LEN = 16
+
+# Символы, которые html.escape заменяет на сущности
+_UNSAFE_RE = re.compile(r"[&<>\"']")
+
+# Параметры scrypt для хэширования паролей
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+
+def hash_password(password, salt=None):
+    """Хэш пароля в формате scrypt$<соль>$<хэш> (hex)"""
+    if salt is None:
+        salt = secrets.token_bytes(16)
+    digest = hashlib.scrypt(password.encode(), salt=salt, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P)
+    return f"scrypt${salt.hex()}${digest.hex()}"
+
+def verify_password(password, stored_hash):
+    """Проверка пароля; старые хэши (sha256 без соли) тоже принимаются"""
+    if not stored_hash:
+        return False
+    if stored_hash.startswith("scrypt$"):
+        _, salt, _ = stored_hash.split("$")
+        candidate = hash_password(password, bytes.fromhex(salt))
+    else:
+        candidate = hashlib.sha256(password.encode()).hexdigest()
+    return hmac.compare_digest(candidate, stored_hash)
+
+# Хэш, с которым сверяется пароль несуществующего пользователя: время ответа
+# не должно выдавать, зарегистрирован ли ник
+DUMMY_HASH = hash_password("")
+
+def client_ip(websocket):
+    """IP клиента для ограничения попыток входа.
+
+    Левые записи X-Forwarded-For задаёт сам клиент; доверять можно только
+    последней, дописанной нашим прокси, и только при TRUST_PROXY.
+    """
+    if TRUST_PROXY:
+        forwarded = websocket.request_headers.get("X-Forwarded-For")
+        if forwarded:
+            return forwarded.rsplit(",", 1)[-1].strip()
+    return websocket.remote_address[0]
+
+def store_media(raw):
+    """Сохраняет вложение в MEDIA_DIR, возвращает маркер для БД"""
+    digest = hashlib.sha256(raw).hexdigest()
+    path = os.path.join(MEDIA_DIR, digest)
+    # Одинаковые файлы хранятся один раз
+    if not os.path.exists(path):
+        os.makedirs(MEDIA_DIR, exist_ok=True)
+        tmp = f"{path}.{secrets.token_hex(4)}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(raw)
+        os.replace(tmp, path)
+    return MEDIA_PREFIX + digest
+
+def store_media_b64(b64):
+    """То же для вложения в base64 (клиенты, не присылающие бинарный кадр)"""
+    return store_media(base64.b64decode(b64, validate=True))
+
+def remove_media(media_data):
+    """Удаляет файл вложения по маркеру из БД"""
+    try:
+        os.remove(os.path.join(MEDIA_DIR, media_data[len(MEDIA_PREFIX):]))
+    except FileNotFoundError:
+        pass
+
+def media_path(media_data):
+    """URL вложения для клиента; старые base64-данные отдаются как есть"""
+    if media_data and media_data.startswith(MEDIA_PREFIX):
+        return "/media/" + media_data[len(MEDIA_PREFIX):]
+    return media_data
+
+def _read_media(digest):
+    with open(os.path.join(MEDIA_DIR, digest), 'rb') as f:
+        return f.read()
+
+def load_static():
+    """Читает файлы клиента в память один раз при запуске; отсутствующие пропускаются"""
+    base = os.path.dirname(os.path.abspath(__file__))
+    static = {}
+    for path, (filename, content_type) in STATIC_FILES.items():
+        try:
+            with open(os.path.join(base, filename), 'rb') as f:
+                static[path] = (content_type, f.read())
+        except FileNotFoundError:
+            pass
+    return static
+
+def setup_logging():
+    """Логи пишет в stderr фоновый поток: event loop не ждёт вывода.
+
+    Возвращает QueueListener, который нужно остановить при выходе.
+    """
+    records = queue.SimpleQueue()
+    output = logging.StreamHandler()
+    output.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    listener = QueueListener(records, output)
+    # Без своего форматтера QueueHandler кладёт в очередь готовый текст
+    # сообщения (с трассировкой), а время и уровень добавляет output
+    logging.root.addHandler(QueueHandler(records))
+    logging.root.setLevel(logging.INFO)
+    # websockets пишет в INFO каждое соединение - оставляем только предупреждения
+    logging.getLogger("websockets").setLevel(logging.WARNING)
+    listener.start()
+    return listener
+
+def escape_html(text):
+    """html.escape только для текста, в котором есть что экранировать"""
+    return html.escape(text) if _UNSAFE_RE.search(text) else text
+
+def dumps(message):
+    """JSON для отправки клиенту: orjson сразу отдаёт UTF-8 bytes.
+
+    Ключи-числа (варианты опроса) превращаются в строки, как в json.dumps.
+    """
+    return orjson.dumps(message, option=orjson.OPT_NON_STR_KEYS)
+
+# Неизменные ответы сериализуются один раз при загрузке модуля
+AUTH_ERR_NICK = dumps({"type": "auth_error", "text": "Ник некорректен."})
+AUTH_ERR_THROTTLED = dumps({"type": "auth_error", "text": "Слишком много попыток, попробуйте позже."})
+AUTH_ERR_ONLINE = dumps({"type": "auth_error", "text": "Уже в сети."})
+AUTH_ERR_FAILED = dumps({"type": "auth_error", "text": "Ошибка входа."})
+ERR_SPAM = dumps({"type": "error", "text": "Вы отправляете слишком много сообщений"})
+ERR_CONTENT = dumps({"type": "error", "text": "Сообщение содержит недопустимый контент"})
+ERR_SELF = dumps({"type": "error", "text": "Нельзя писать сообщения самому себе"})
+ERR_BANNED = dumps({"type": "error", "text": "Вы забанены в этой группе."})
+ERR_MEDIA = dumps({"type": "error", "text": "Некорректное вложение"})
+ERR_JOIN = dumps({"type": "error", "text": "Не удалось присоединиться к группе"})
+INFO_PROFILE = dumps({"type": "info", "text": "Профиль обновлен"})
+
+def now_ms():
+    """Текущее время в целых миллисекундах, как его получают клиенты"""
+    return time.time_ns() // 1_000_000
+
+# Колонки messages, которые читает _format_message
+MESSAGE_COLUMNS = "id, sender, mtype, text, media_data, filename, reply_to_json, thread_id, is_edited, is_read, timestamp"
+
+# Список для IN передаётся одним JSON-параметром, чтобы текст запроса не
+# зависел от длины списка
+IN_LIST = "SELECT value FROM json_each(?)"
+
+def json_list(values):
+    """Параметр для IN (IN_LIST)"""
+    return orjson.dumps(values).decode()
 
 class Database:
     def __init__(self, db_name):
-        self.conn = sqlite3.connect(db_name, check_same_thread=False)
-        self.conn.row_factory = sqlite3.Row
-        self.cursor = self.conn.cursor()
+        """Соединение на запись"""
+        self.conn = self._connect(db_name, cache_kib=65536)
+        # WAL + synchronous=NORMAL: коммит не делает fsync на каждое сообщение
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA temp_store=MEMORY")
+        self.pending_commit = False  # есть незафиксированные изменения
+        self.user_cache = {}  # {username: профиль}, см. get_user_info
         self.init_db()
 
+    @classmethod
+    def open_reader(cls, db_name, user_cache):
+        """Read-only соединение читателя, разделяющее кэш профилей с пишущим (см. AsyncDatabase)"""
+        db = cls.__new__(cls)
+        db.conn = cls._connect(f"file:{db_name}?mode=ro", cache_kib=16384, uri=True)
+        db.pending_commit = False
+        db.user_cache = user_cache
+        return db
+
+    @staticmethod
+    def _connect(database, cache_kib, uri=False):
+        """Соединение с общими для писателя и читателей настройками"""
+        # conn.execute берёт подготовленные выражения из кэша соединения.
+        # Соединение создаётся и используется только в своём потоке -
+        # обращение из другого потока sqlite3 отклонит
+        conn = sqlite3.connect(database, uri=uri, cached_statements=256)
+        conn.row_factory = sqlite3.Row
+        conn.execute(f"PRAGMA cache_size=-{cache_kib}")
+        conn.execute("PRAGMA mmap_size=268435456")  # 256 MB
+        conn.execute("PRAGMA busy_timeout=5000")
+        return conn
+
     def init_db(self):
         # 1. Пользователи
-        self.cursor.execute('''
+        self.conn.execute('''
             CREATE TABLE IF NOT EXISTS users (
                 username TEXT PRIMARY KEY,
                 password_hash TEXT,
@@ -45,7 +323,7 @@ class Database:
             )
         ''')
         # 2. Комнаты
-        self.cursor.execute('''
+        self.conn.execute('''
             CREATE TABLE IF NOT EXISTS rooms (
                 id TEXT PRIMARY KEY,
                 name TEXT UNIQUE,
@@ -57,7 +335,7 @@ class Database:
             )
         ''')
         # 3. Баны
-        self.cursor.execute('''
+        self.conn.execute('''
             CREATE TABLE IF NOT EXISTS bans (
                 room_id TEXT,
                 username TEXT,
@@ -66,7 +344,7 @@ class Database:
             )
         ''')
         # 4. Сообщения
-        self.cursor.execute('''
+        self.conn.execute('''
             CREATE TABLE IF NOT EXISTS messages (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 target TEXT,
@@ -86,7 +364,7 @@ class Database:
             )
         ''')
         # 5. Реакции
-        self.cursor.execute('''
+        self.conn.execute('''
             CREATE TABLE IF NOT EXISTS reactions (
                 message_id INTEGER,
                 sender TEXT,
@@ -95,7 +373,7 @@ class Database:
             )
         ''')
         # 6. Голоса
-        self.cursor.execute('''
+        self.conn.execute('''
             CREATE TABLE IF NOT EXISTS votes (
                 message_id INTEGER,
                 username TEXT,
@@ -104,7 +382,7 @@ class Database:
             )
         ''')
         # 7. Закладки
-        self.cursor.execute('''
+        self.conn.execute('''
             CREATE TABLE IF NOT EXISTS bookmarks (
                 username TEXT,
                 message_id INTEGER,
@@ -113,7 +391,7 @@ class Database:
             )
         ''')
         # 8. Приглашения для групп
-        self.cursor.execute('''
+        self.conn.execute('''
             CREATE TABLE IF NOT EXISTS invite_codes (
                 code TEXT PRIMARY KEY,
                 room_id TEXT,
@@ -124,7 +402,7 @@ class Database:
             )
         ''')
         # 9. Члены групп с ролями
-        self.cursor.execute('''
+        self.conn.execute('''
             CREATE TABLE IF NOT EXISTS room_members (
                 room_id TEXT,
                 username TEXT,
@@ -135,17 +413,24 @@ class Database:
             )
         ''')
         # 10. Удаленные сообщения (для администраторов)
-        self.cursor.execute('''
+        self.conn.execute('''
             CREATE TABLE IF NOT EXISTS deleted_messages (
                 id INTEGER PRIMARY KEY,
                 message_id INTEGER,
                 deleted_by TEXT,
                 reason TEXT,
-                deleted_at REAL
+                deleted_at REAL,
+                target TEXT,
+                text TEXT
             )
         ''')
+        # В БД старой версии этих колонок нет
+        columns = {row['name'] for row in self.conn.execute("PRAGMA table_info(deleted_messages)")}
+        for column in ("target", "text"):
+            if column not in columns:
+                self.conn.execute(f"ALTER TABLE deleted_messages ADD COLUMN {column} TEXT")
         # 11. Запланированные сообщения
-        self.cursor.execute('''
+        self.conn.execute('''
             CREATE TABLE IF NOT EXISTS scheduled_messages (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 target TEXT,
@@ -157,143 +442,250 @@ class Database:
                 sent INTEGER DEFAULT 0
             )
         ''')
+        # 12. Индексы для горячих запросов истории, поиска и прочтения
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_msg_ctx_target ON messages(context, target, id DESC)"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_msg_ctx_sender_target ON messages(context, sender, target, id DESC)"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_msg_thread ON messages(thread_id, id)"
+        )
+        # Частичный индекс: только неотправленные, MIN(scheduled_time) берётся из него
+        self.conn.execute("DROP INDEX IF EXISTS idx_msg_scheduled")
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_scheduled_pending ON scheduled_messages(scheduled_time) WHERE sent=0"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_deleted_target ON deleted_messages(target, deleted_at DESC)"
+        )
         self.conn.commit()
 
+    # --- TRANSACTIONS ---
+    def flush(self):
+        """Фиксирует накопленные изменения одним commit.
+
+        Методы записи не коммитят сами, а только помечают транзакцию:
+        ChatServer.commit_flusher вызывает flush раз в COMMIT_INTERVAL,
+        и все действия пользователей за этот период уходят одним fsync.
+        """
+        if self.pending_commit:
+            self.conn.commit()
+            self.pending_commit = False
+
     # --- AUTH ---
-    def register_user(self, username, password):
+    def register_user(self, username, password_hash):
         try:
-            phash = hashlib.sha256(password.encode()).hexdigest()
-            self.cursor.execute(
+            self.conn.execute(
                 "INSERT INTO users (username, password_hash, created_at) VALUES (?, ?, ?)", 
-                (username, phash, time.time())
+                (username, password_hash, time.time())
             )
-            self.conn.commit()
+            self.pending_commit = True
+            self.user_cache.pop(username, None)
             return True
         except sqlite3.IntegrityError:
             return False
 
-    def check_login(self, username, password):
-        phash = hashlib.sha256(password.encode()).hexdigest()
-        self.cursor.execute(
-            "SELECT * FROM users WHERE username=? AND password_hash=?", 
-            (username, phash)
+    def get_password_hash(self, username):
+        cur = self.conn.execute(
+            "SELECT password_hash FROM users WHERE username=?", 
+            (username,)
         )
-        return self.cursor.fetchone() is not None
+        row = cur.fetchone()
+        return row['password_hash'] if row else None
 
-    def get_user_info(self, username):
-        self.cursor.execute(
-            "SELECT username, avatar, bio, user_status FROM users WHERE username=?", 
-            (username,)
+    def set_password_hash(self, username, password_hash):
+        self.conn.execute(
+            "UPDATE users SET password_hash=? WHERE username=?", 
+            (password_hash, username)
         )
-        row = self.cursor.fetchone()
-        return dict(row) if row else None
+        self.pending_commit = True
+
+    def get_user_info(self, username):
+        """Профиль пользователя; кэшируется до изменения профиля или статуса"""
+        user = self.user_cache.get(username)
+        if user is None:
+            cur = self.conn.execute(
+                "SELECT username, avatar, bio, user_status FROM users WHERE username=?", 
+                (username,)
+            )
+            row = cur.fetchone()
+            if not row:
+                return None
+            if len(self.user_cache) >= USER_CACHE_SIZE:
+                # Вытесняем самую старую запись
+                del self.user_cache[next(iter(self.user_cache))]
+            user = self.user_cache[username] = dict(row)
+        return dict(user)
 
     def update_profile(self, username, avatar, bio):
-        self.cursor.execute(
+        self.conn.execute(
             "UPDATE users SET avatar=?, bio=? WHERE username=?", 
             (avatar, bio, username)
         )
-        self.conn.commit()
+        self.pending_commit = True
+        self.user_cache.pop(username, None)
 
     def update_user_status(self, username, status):
-        self.cursor.execute(
+        self.conn.execute(
             "UPDATE users SET user_status=? WHERE username=?", 
             (status, username)
         )
-        self.conn.commit()
+        self.pending_commit = True
+        self.user_cache.pop(username, None)
+
+    def get_user_profiles(self, usernames):
+        """Профили нескольких пользователей: из кэша, недостающие - одним запросом"""
+        profiles = {nick: self.user_cache[nick] for nick in usernames if nick in self.user_cache}
+        missing = [nick for nick in usernames if nick not in profiles]
+        if missing:
+            cur = self.conn.execute(
+                f"SELECT username, avatar, bio, user_status FROM users WHERE username IN ({IN_LIST})",
+                (json_list(missing),)
+            )
+            for row in cur.fetchall():
+                profiles[row['username']] = self.user_cache[row['username']] = dict(row)
+            while len(self.user_cache) > USER_CACHE_SIZE:
+                del self.user_cache[next(iter(self.user_cache))]
+        return profiles
 
     def get_contacts(self, username):
-        self.cursor.execute('''
+        cur = self.conn.execute('''
             SELECT DISTINCT sender as c FROM messages WHERE context='pm' AND target=?
             UNION
             SELECT DISTINCT target as c FROM messages WHERE context='pm' AND sender=?
         ''', (username, username))
-        return [row['c'] for row in self.cursor.fetchall()]
+        return [row['c'] for row in cur.fetchall()]
 
     # --- ROOMS & MEMBERS ---
     def create_room(self, name, creator, rtype):
         try:
             # Генерируем ID как @название (но в нижнем регистре без пробелов)
             room_id = "@" + name.lower().replace(" ", "")
-            self.cursor.execute(
+            self.conn.execute(
                 "INSERT INTO rooms (id, name, creator, type, created_at) VALUES (?, ?, ?, ?, ?)", 
                 (room_id, name, creator, rtype, time.time())
             )
-            self.cursor.execute(
+            self.conn.execute(
                 "INSERT INTO room_members (room_id, username, role, joined_at) VALUES (?, ?, ?, ?)",
                 (room_id, creator, "admin", time.time())
             )
-            self.conn.commit()
-            return True
+            self.pending_commit = True
+            return room_id
         except sqlite3.IntegrityError:
-            return False
+            return None
 
     def get_rooms(self, username=None):
         """Get rooms where user is a member. If username is None, return all rooms."""
+        # Member count comes from a single GROUP BY instead of a query per room
         if username:
-            self.cursor.execute("""
-                SELECT r.* FROM rooms r
+            cur = self.conn.execute("""
+                SELECT r.*, COALESCE(mc.count, 0) AS member_count FROM rooms r
                 INNER JOIN room_members rm ON r.id = rm.room_id
+                LEFT JOIN (SELECT room_id, COUNT(*) AS count FROM room_members GROUP BY room_id) mc
+                    ON mc.room_id = r.id
                 WHERE rm.username = ?
                 ORDER BY r.created_at DESC
             """, (username,))
         else:
-            self.cursor.execute("SELECT * FROM rooms ORDER BY created_at DESC")
-        
-        rooms = [dict(row) for row in self.cursor.fetchall()]
-        # Add member count to each room
-        for room in rooms:
-            self.cursor.execute("SELECT COUNT(*) as count FROM room_members WHERE room_id=?", (room['id'],))
-            room['member_count'] = self.cursor.fetchone()['count']
-        return rooms
+            cur = self.conn.execute("""
+                SELECT r.*, COALESCE(mc.count, 0) AS member_count FROM rooms r
+                LEFT JOIN (SELECT room_id, COUNT(*) AS count FROM room_members GROUP BY room_id) mc
+                    ON mc.room_id = r.id
+                ORDER BY r.created_at DESC
+            """)
+        return [dict(row) for row in cur.fetchall()]
+
+    def get_room(self, room_id):
+        """Одна комната в том же виде, что и элементы get_rooms"""
+        cur = self.conn.execute("""
+            SELECT r.*, (SELECT COUNT(*) FROM room_members WHERE room_id = r.id) AS member_count
+            FROM rooms r WHERE r.id = ?
+        """, (room_id,))
+        row = cur.fetchone()
+        return dict(row) if row else None
 
     def get_room_info(self, room_id):
         # Попытаемся найти по ID сначала, потом по имени (для обратной совместимости)
-        self.cursor.execute("SELECT * FROM rooms WHERE id=?", (room_id,))
-        row = self.cursor.fetchone()
+        cur = self.conn.execute("SELECT * FROM rooms WHERE id=?", (room_id,))
+        row = cur.fetchone()
         if not row:
-            self.cursor.execute("SELECT * FROM rooms WHERE name=?", (room_id,))
-            row = self.cursor.fetchone()
+            cur = self.conn.execute("SELECT * FROM rooms WHERE name=?", (room_id,))
+            row = cur.fetchone()
         return dict(row) if row else None
 
     def get_room_members(self, room_id):
-        self.cursor.execute(
-            "SELECT username, role, joined_at FROM room_members WHERE room_id=? ORDER BY joined_at ASC", 
-            (room_id,)
-        )
-        members = [dict(row) for row in self.cursor.fetchall()]
-        # Get avatar for each member
-        for member in members:
-            user = self.get_user_info(member['username'])
-            if user:
-                member['avatar'] = user.get('avatar')
-        return members
-
-    def search_rooms(self, query):
-        """Search rooms by ID (starts with @) or name"""
+        # Аватары участников приходят тем же запросом, без обращения к профилю каждого
+        cur = self.conn.execute("""
+            SELECT rm.username, rm.role, rm.joined_at, u.avatar FROM room_members rm
+            LEFT JOIN users u ON u.username = rm.username
+            WHERE rm.room_id=? ORDER BY rm.joined_at ASC
+        """, (room_id,))
+        return [dict(row) for row in cur.fetchall()]
+
+    def get_room_bundle(self, room_id):
+        """Всё о комнате для history_req за одно обращение к БД:
+        (room_info с members и member_count, закреплённое сообщение)"""
+        room_info = self.get_room_info(room_id)
+        if not room_info:
+            return None, None
+        members = self.get_room_members(room_id)
+        room_info['members'] = members
+        room_info['member_count'] = len(members)
+        pinned = self.get_formatted_message(room_info['pinned_msg_id']) if room_info['pinned_msg_id'] else None
+        return room_info, pinned
+
+    def get_memberships(self):
+        """Все пары (room_id, username) без забаненных - для индекса участников в ChatServer"""
+        cur = self.conn.execute("""
+            SELECT m.room_id, m.username FROM room_members m
+            WHERE NOT EXISTS (SELECT 1 FROM bans b WHERE b.room_id = m.room_id AND b.username = m.username)
+        """)
+        return [(row['room_id'], row['username']) for row in cur.fetchall()]
+
+    def search_rooms(self, query, username):
+        """Search rooms by ID (starts with @) or name; is_member is set for username"""
         if query.startswith('@'):
             # Search by ID
             query = query[1:]  # Remove @
-            self.cursor.execute("SELECT * FROM rooms WHERE id LIKE ? ORDER BY created_at DESC", (f'@{query}%',))
+            where, param = "r.id LIKE ?", f'@{query}%'
         else:
             # Search by name
-            self.cursor.execute("SELECT * FROM rooms WHERE name LIKE ? ORDER BY created_at DESC", (f'%{query}%',))
+            where, param = "r.name LIKE ?", f'%{query}%'
         
-        rooms = [dict(row) for row in self.cursor.fetchall()]
-        # Add member count
-        for room in rooms:
-            self.cursor.execute("SELECT COUNT(*) as count FROM room_members WHERE room_id=?", (room['id'],))
-            room['member_count'] = self.cursor.fetchone()['count']
-        return rooms
+        # Членство проверяется тем же запросом, а не отдельным запросом на комнату
+        cur = self.conn.execute(f"""
+            SELECT r.*, COALESCE(mc.count, 0) AS member_count,
+                   me.username IS NOT NULL AS is_member
+            FROM rooms r
+            LEFT JOIN (SELECT room_id, COUNT(*) AS count FROM room_members GROUP BY room_id) mc
+                ON mc.room_id = r.id
+            LEFT JOIN room_members me ON me.room_id = r.id AND me.username = ?
+            WHERE {where}
+            ORDER BY r.created_at DESC
+        """, (username, param))
+        return [dict(row, is_member=bool(row['is_member'])) for row in cur.fetchall()]
+
+    def rename_room(self, room_id, new_name):
+        # Обновляем только название, ID остаётся прежним
+        self.conn.execute("UPDATE rooms SET name=? WHERE id=?", (new_name, room_id))
+        self.pending_commit = True
+
+    def update_room_avatar(self, room_id, avatar):
+        self.conn.execute("UPDATE rooms SET avatar=? WHERE id=?", (avatar, room_id))
+        self.pending_commit = True
 
     def join_room(self, room_id, username):
-        """Add user to room if not already member"""
+        """Add user to room if not already member and not banned there"""
+        if self.is_banned(room_id, username):
+            return False
         try:
-            self.cursor.execute(
+            self.conn.execute(
                 "INSERT INTO room_members (room_id, username, role, joined_at) VALUES (?, ?, ?, ?)",
                 (room_id, username, "member", time.time())
             )
-            self.conn.commit()
+            self.pending_commit = True
             return True
         except sqlite3.IntegrityError:
             return False
@@ -301,21 +693,21 @@ class Database:
     def search_users(self, query, exclude_username=None):
         """Search users by username, optionally excluding current user"""
         if exclude_username:
-            self.cursor.execute(
+            cur = self.conn.execute(
                 "SELECT username, avatar, bio, user_status FROM users WHERE username LIKE ? AND username != ? LIMIT 20", 
                 (f'%{query}%', exclude_username)
             )
         else:
-            self.cursor.execute(
+            cur = self.conn.execute(
                 "SELECT username, avatar, bio, user_status FROM users WHERE username LIKE ? LIMIT 20", 
                 (f'%{query}%',)
             )
-        return [dict(row) for row in self.cursor.fetchall()]
+        return [dict(row) for row in cur.fetchall()]
 
     def get_recent_contacts(self, username, limit=15):
         """Get recent contacts from message history"""
         # Find unique users from recent PM conversations (target is the other user for PMs)
-        self.cursor.execute("""
+        cur = self.conn.execute("""
             SELECT DISTINCT CASE 
                 WHEN sender = ? THEN target 
                 ELSE sender 
@@ -328,7 +720,7 @@ class Database:
         
         contacts = []
         seen = set()
-        for row in self.cursor.fetchall():
+        for row in cur.fetchall():
             contact_name = row['contact_user']
             if contact_name and contact_name not in seen:
                 seen.add(contact_name)
@@ -339,21 +731,35 @@ class Database:
 
     def add_room_member(self, room_id, username, role='member'):
         try:
-            self.cursor.execute(
+            self.conn.execute(
                 "INSERT INTO room_members (room_id, username, role, joined_at) VALUES (?, ?, ?, ?)",
                 (room_id, username, role, time.time())
             )
-            self.conn.commit()
+            self.pending_commit = True
             return True
         except:
             return False
 
+    def remove_room_member(self, room_id, username):
+        self.conn.execute(
+            "DELETE FROM room_members WHERE room_id=? AND username=?",
+            (room_id, username)
+        )
+        self.pending_commit = True
+
+    def change_member_role(self, room_id, username, role):
+        self.conn.execute(
+            "UPDATE room_members SET role=? WHERE room_id=? AND username=?",
+            (role, room_id, username)
+        )
+        self.pending_commit = True
+
     def get_user_role(self, room_id, username):
-        self.cursor.execute(
+        cur = self.conn.execute(
             "SELECT role FROM room_members WHERE room_id=? AND username=?",
             (room_id, username)
         )
-        row = self.cursor.fetchone()
+        row = cur.fetchone()
         return row['role'] if row else None
 
     # --- INVITE CODES ---
@@ -361,21 +767,21 @@ class Database:
         code = secrets.token_urlsafe(8)
         expires_at = time.time() + (hours * 3600)
         try:
-            self.cursor.execute(
+            self.conn.execute(
                 "INSERT INTO invite_codes (code, room_id, creator, created_at, expires_at) VALUES (?, ?, ?, ?, ?)",
                 (code, room_id, creator, time.time(), expires_at)
             )
-            self.conn.commit()
+            self.pending_commit = True
             return code
         except:
             return None
 
     def use_invite_code(self, code, username):
-        self.cursor.execute(
+        cur = self.conn.execute(
             "SELECT room_id, expires_at FROM invite_codes WHERE code=?", 
             (code,)
         )
-        row = self.cursor.fetchone()
+        row = cur.fetchone()
         if not row:
             return None, "Код не найден"
         
@@ -383,6 +789,11 @@ class Database:
             return None, "Код истёк"
         
         room_id = row['room_id']
+        # Код мог пережить удаление группы
+        if not self.conn.execute("SELECT 1 FROM rooms WHERE id=?", (room_id,)).fetchone():
+            return None, "Группа не найдена"
+        if self.is_banned(room_id, username):
+            return None, "Вы забанены в этой группе"
         if self.add_room_member(room_id, username):
             return room_id, "OK"
         return None, "Ошибка добавления в группу"
@@ -391,16 +802,17 @@ class Database:
     def save_message(self, data):
         context = 'room' if 'room_name' in data else 'pm'
         target = data.get('room_name') if context == 'room' else data.get('recipient')
-        reply_json = json.dumps(data.get("replyTo")) if data.get("replyTo") else None
-        ts = data.get('timestamp', time.time())
+        # TEXT-колонки: orjson отдаёт bytes, в БД кладём str
+        reply_json = orjson.dumps(data.get("replyTo")).decode() if data.get("replyTo") else None
+        ts = data['timestamp'] / 1000 if 'timestamp' in data else time.time()
         thread_id = data.get('thread_id')
         scheduled_time = data.get('scheduled_time')
         
         media = data.get("data")
         if data.get("type") == "poll":
-            media = json.dumps(data.get("options"))
+            media = orjson.dumps(data.get("options")).decode()
 
-        self.cursor.execute('''
+        cur = self.conn.execute('''
             INSERT INTO messages (target, context, sender, mtype, text, media_data, filename, 
                                  reply_to_json, thread_id, timestamp, scheduled_time)
             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
@@ -409,24 +821,29 @@ class Database:
             data.get("text"), media, data.get("filename"), 
             reply_json, thread_id, ts, scheduled_time
         ))
-        self.conn.commit()
-        return self.cursor.lastrowid
+        self.pending_commit = True
+        return cur.lastrowid
 
     def get_message(self, msg_id):
-        self.cursor.execute("SELECT * FROM messages WHERE id=?", (msg_id,))
-        row = self.cursor.fetchone()
+        cur = self.conn.execute("SELECT * FROM messages WHERE id=?", (msg_id,))
+        row = cur.fetchone()
         return dict(row) if row else None
 
+    def get_formatted_message(self, msg_id):
+        """Одно сообщение в том же виде, что и в истории (время в мс, путь к медиа)"""
+        cur = self.conn.execute(f"SELECT {MESSAGE_COLUMNS} FROM messages WHERE id=?", (msg_id,))
+        msgs = self._format_messages(cur.fetchall())
+        return msgs[0] if msgs else None
+
     def search_messages(self, context, target, viewer, query, start_date=None, end_date=None, limit=100):
-        sql = "SELECT * FROM messages WHERE context=? AND "
-        params = [context]
-        
         if context == 'room':
-            sql += "target = ?"
-            params.append(target)
+            sql = f"SELECT {MESSAGE_COLUMNS} FROM messages WHERE context=? AND target = ?"
+            params = [context, target]
         else:
-            sql += "((sender = ? AND target = ?) OR (sender = ? AND target = ?))"
-            params.extend([viewer, target, target, viewer])
+            # context повторяется в каждой ветке OR, чтобы обе ветки шли по индексу
+            sql = (f"SELECT {MESSAGE_COLUMNS} FROM messages WHERE "
+                   "((context=? AND sender = ? AND target = ?) OR (context=? AND sender = ? AND target = ?))")
+            params = [context, viewer, target, context, target, viewer]
 
         sql += " AND (text LIKE ?"
         params.append(f"%{query}%")
@@ -441,127 +858,174 @@ class Database:
         sql += ") ORDER BY id DESC LIMIT ?"
         params.append(limit)
         
-        self.cursor.execute(sql, tuple(params))
-        rows = self.cursor.fetchall()
-        return [self._format_message(row) for row in reversed(rows)]
+        cur = self.conn.execute(sql, tuple(params))
+        rows = cur.fetchall()
+        return self._format_messages(list(reversed(rows)), viewer)
+
+    def _format_messages(self, rows, viewer=None):
+        """Форматирует пачку сообщений: реакции, закладки, аватары и голоса
+        загружаются отдельным запросом на всю пачку, а не по запросу на строку.
+        is_bookmarked - закладки viewer; без него сообщения не отмечаются"""
+        if not rows:
+            return []
+        msg_ids = [row['id'] for row in rows]
+        senders = list({row['sender'] for row in rows})
+        poll_ids = [row['id'] for row in rows if row['mtype'] == "poll"]
+
+        reactions = defaultdict(dict)
+        cur = self.conn.execute(
+            f"SELECT message_id, emoji, sender FROM reactions WHERE message_id IN ({IN_LIST})",
+            (json_list(msg_ids),)
+        )
+        for row in cur.fetchall():
+            reactions[row['message_id']].setdefault(row['emoji'], []).append(row['sender'])
+
+        bookmarked = set()
+        if viewer:
+            cur = self.conn.execute(
+                f"SELECT message_id FROM bookmarks WHERE username=? AND message_id IN ({IN_LIST})",
+                (viewer, json_list(msg_ids))
+            )
+            bookmarked = {row['message_id'] for row in cur.fetchall()}
+
+        # Аватары берём из кэша профилей, в БД идём только за недостающими
+        # (get, а не in + [] - читатели обращаются к кэшу из других потоков)
+        cached = {nick: self.user_cache.get(nick) for nick in senders}
+        avatars = {nick: user['avatar'] for nick, user in cached.items() if user}
+        missing = [nick for nick in senders if nick not in avatars]
+        if missing:
+            cur = self.conn.execute(
+                f"SELECT username, avatar FROM users WHERE username IN ({IN_LIST})",
+                (json_list(missing),)
+            )
+            avatars.update((row['username'], row['avatar']) for row in cur.fetchall())
 
-    def _format_message(self, row):
+        poll_results = defaultdict(dict)
+        if poll_ids:
+            cur = self.conn.execute(
+                f"SELECT message_id, option_index, username FROM votes WHERE message_id IN ({IN_LIST})",
+                (json_list(poll_ids),)
+            )
+            for row in cur.fetchall():
+                poll_results[row['message_id']].setdefault(row['option_index'], []).append(row['username'])
+
+        return [self._format_message(row, reactions, avatars, poll_results, bookmarked) for row in rows]
+
+    def _format_message(self, row, reactions, avatars, poll_results, bookmarked):
         msg_id = row['id']
-        reactions = self.get_reactions(msg_id)
-        sender_info = self.get_user_info(row["sender"])
         
         msg_obj = {
             "id": msg_id,
             "type": row["mtype"],
             "sender": row["sender"],
-            "sender_avatar": sender_info['avatar'] if sender_info else None,
+            "sender_avatar": avatars.get(row["sender"]),
             "text": row["text"],
-            "data": row["media_data"],
+            "data": media_path(row["media_data"]),
             "filename": row["filename"],
-            "timestamp": row["timestamp"],
+            "timestamp": round(row["timestamp"] * 1000),
             "is_edited": row["is_edited"],
             "is_read": row["is_read"],
-            "is_bookmarked": row["is_bookmarked"],
+            "is_bookmarked": int(msg_id in bookmarked),
             "thread_id": row["thread_id"],
-            "replyTo": json.loads(row["reply_to_json"]) if row["reply_to_json"] else None,
-            "reactions": reactions
+            "replyTo": orjson.loads(row["reply_to_json"]) if row["reply_to_json"] else None,
+            "reactions": reactions.get(msg_id, {})
         }
         if row["mtype"] == "poll":
-            msg_obj["poll_results"] = self.get_poll_results(msg_id)
+            msg_obj["poll_results"] = poll_results.get(msg_id, {})
         return msg_obj
 
     def edit_message(self, msg_id, sender, new_text):
-        self.cursor.execute(
+        cur = self.conn.execute(
             "UPDATE messages SET text=?, is_edited=1 WHERE id=? AND sender=?", 
             (new_text, msg_id, sender)
         )
-        self.conn.commit()
-        return self.cursor.rowcount > 0
+        self.pending_commit = True
+        return cur.rowcount > 0
 
     def delete_message(self, msg_id, sender, is_admin=False, reason=""):
-        self.cursor.execute("SELECT sender FROM messages WHERE id=?", (msg_id,))
-        row = self.cursor.fetchone()
+        cur = self.conn.execute("SELECT sender, target, text, media_data FROM messages WHERE id=?", (msg_id,))
+        row = cur.fetchone()
         if not row:
             return False
         
         if is_admin or row['sender'] == sender:
-            self.cursor.execute("DELETE FROM messages WHERE id=?", (msg_id,))
-            self.cursor.execute(
-                "INSERT INTO deleted_messages (message_id, deleted_by, reason, deleted_at) VALUES (?, ?, ?, ?)",
-                (msg_id, sender, reason, time.time())
+            self.conn.execute("DELETE FROM messages WHERE id=?", (msg_id,))
+            # Одинаковые вложения хранятся одним файлом - удаляем его, только
+            # если на него больше не ссылается ни одно сообщение
+            media_data = row['media_data']
+            if media_data and media_data.startswith(MEDIA_PREFIX) and not self.conn.execute(
+                    "SELECT 1 FROM messages WHERE media_data=? LIMIT 1", (media_data,)).fetchone():
+                remove_media(media_data)
+            # target и text сохраняем в журнал: после удаления их уже не достать
+            self.conn.execute(
+                "INSERT INTO deleted_messages (message_id, deleted_by, reason, deleted_at, target, text) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (msg_id, sender, reason, time.time(), row['target'], row['text'])
             )
-            self.conn.commit()
+            self.pending_commit = True
             return True
         return False
 
     def mark_read(self, sender, recipient):
-        self.cursor.execute(
+        cur = self.conn.execute(
             "UPDATE messages SET is_read=1 WHERE context='pm' AND sender=? AND target=? AND is_read=0", 
             (sender, recipient)
         )
-        self.conn.commit()
-        return self.cursor.rowcount > 0
+        self.pending_commit = True
+        return cur.rowcount > 0
 
     def get_history(self, context, target, viewer, limit=100):
-        query = "SELECT * FROM messages WHERE context=? AND "
-        params = [context]
-        
         if context == 'room':
-            query += "target = ?"
-            params.append(target)
+            query = f"SELECT {MESSAGE_COLUMNS} FROM messages WHERE context=? AND target = ?"
+            params = [context, target]
         else:
-            query += "((sender = ? AND target = ?) OR (sender = ? AND target = ?))"
-            params.extend([viewer, target, target, viewer])
+            # context повторяется в каждой ветке OR, чтобы обе ветки шли по индексу
+            query = (f"SELECT {MESSAGE_COLUMNS} FROM messages WHERE "
+                     "((context=? AND sender = ? AND target = ?) OR (context=? AND sender = ? AND target = ?))")
+            params = [context, viewer, target, context, target, viewer]
 
         query += " ORDER BY id DESC LIMIT ?"
         params.append(limit)
         
-        self.cursor.execute(query, tuple(params))
-        rows = self.cursor.fetchall()
-        return [self._format_message(row) for row in reversed(rows)]
+        cur = self.conn.execute(query, tuple(params))
+        rows = cur.fetchall()
+        return self._format_messages(list(reversed(rows)), viewer)
 
-    def get_thread_messages(self, thread_id, limit=50):
-        self.cursor.execute(
-            "SELECT * FROM messages WHERE thread_id=? ORDER BY id ASC LIMIT ?",
+    def get_thread_messages(self, thread_id, viewer=None, limit=50):
+        cur = self.conn.execute(
+            f"SELECT {MESSAGE_COLUMNS} FROM messages WHERE thread_id=? ORDER BY id ASC LIMIT ?",
             (thread_id, limit)
         )
-        rows = self.cursor.fetchall()
-        return [self._format_message(row) for row in rows]
+        rows = cur.fetchall()
+        return self._format_messages(rows, viewer)
 
     def toggle_bookmark(self, username, message_id):
-        self.cursor.execute(
-            "SELECT * FROM bookmarks WHERE username=? AND message_id=?",
+        # Удаляем закладку, а если удалять было нечего - ставим её.
+        # Флаг is_bookmarked вычисляется при чтении (см. _format_messages)
+        cur = self.conn.execute(
+            "DELETE FROM bookmarks WHERE username=? AND message_id=?",
             (username, message_id)
         )
-        if self.cursor.fetchone():
-            self.cursor.execute(
-                "DELETE FROM bookmarks WHERE username=? AND message_id=?",
-                (username, message_id)
-            )
-        else:
-            self.cursor.execute(
+        if cur.rowcount == 0:
+            self.conn.execute(
                 "INSERT INTO bookmarks (username, message_id, created_at) VALUES (?, ?, ?)",
                 (username, message_id, time.time())
             )
-        self.cursor.execute(
-            "UPDATE messages SET is_bookmarked=1 WHERE id=? AND EXISTS(SELECT 1 FROM bookmarks WHERE message_id=?)",
-            (message_id, message_id)
-        )
-        self.conn.commit()
+        self.pending_commit = True
 
     # --- VOTES & REACTIONS ---
     def vote_poll(self, msg_id, username, option_index):
-        self.cursor.execute(
+        self.conn.execute(
             "REPLACE INTO votes (message_id, username, option_index) VALUES (?, ?, ?)", 
             (msg_id, username, option_index)
         )
-        self.conn.commit()
+        self.pending_commit = True
         return self.get_poll_results(msg_id)
 
     def get_poll_results(self, msg_id):
-        self.cursor.execute("SELECT option_index, username FROM votes WHERE message_id=?", (msg_id,))
+        cur = self.conn.execute("SELECT option_index, username FROM votes WHERE message_id=?", (msg_id,))
         results = {}
-        for row in self.cursor.fetchall():
+        for row in cur.fetchall():
             idx = row['option_index']
             if idx not in results: 
                 results[idx] = []
@@ -569,160 +1033,440 @@ class Database:
         return results
 
     def toggle_reaction(self, msg_id, sender, emoji):
-        self.cursor.execute(
-            "SELECT * FROM reactions WHERE message_id=? AND sender=? AND emoji=?", 
+        cur = self.conn.execute(
+            "DELETE FROM reactions WHERE message_id=? AND sender=? AND emoji=?", 
             (msg_id, sender, emoji)
         )
-        if self.cursor.fetchone():
-            self.cursor.execute(
-                "DELETE FROM reactions WHERE message_id=? AND sender=? AND emoji=?", 
-                (msg_id, sender, emoji)
-            )
-        else:
-            self.cursor.execute(
+        if cur.rowcount == 0:
+            self.conn.execute(
                 "INSERT INTO reactions (message_id, sender, emoji) VALUES (?, ?, ?)", 
                 (msg_id, sender, emoji)
             )
-        self.conn.commit()
+        self.pending_commit = True
         return self.get_reactions(msg_id)
 
     def get_reactions(self, msg_id):
-        self.cursor.execute("SELECT emoji, sender FROM reactions WHERE message_id=?", (msg_id,))
+        cur = self.conn.execute("SELECT emoji, sender FROM reactions WHERE message_id=?", (msg_id,))
         result = {}
-        for row in self.cursor.fetchall():
+        for row in cur.fetchall():
             emoji = row['emoji']
             if emoji not in result: 
                 result[emoji] = []
             result[emoji].append(row['sender'])
         return result
 
+    def next_scheduled_time(self):
+        cur = self.conn.execute("SELECT MIN(scheduled_time) AS t FROM scheduled_messages WHERE sent=0")
+        return cur.fetchone()['t']
+
+    def process_scheduled_messages(self):
+        cur = self.conn.execute(
+            "SELECT * FROM scheduled_messages WHERE sent=0 AND scheduled_time <= ?",
+            (time.time(),)
+        )
+        rows = cur.fetchall()
+        # Здесь можно добавить логику отправки
+        if rows:
+            self.conn.executemany(
+                "UPDATE scheduled_messages SET sent=1 WHERE id=?",
+                [(row['id'],) for row in rows]
+            )
+            self.pending_commit = True
+
     def pin_message(self, room_id, msg_id):
-        self.cursor.execute("UPDATE rooms SET pinned_msg_id=? WHERE id=?", (msg_id, room_id))
-        self.conn.commit()
+        self.conn.execute("UPDATE rooms SET pinned_msg_id=? WHERE id=?", (msg_id, room_id))
+        self.pending_commit = True
 
     def ban_user(self, room_id, username):
         try:
-            self.cursor.execute(
+            self.conn.execute(
                 "INSERT INTO bans (room_id, username) VALUES (?, ?)", 
                 (room_id, username)
             )
-            self.conn.commit()
+            self.pending_commit = True
         except:
             pass
 
     def is_banned(self, room_id, username):
-        self.cursor.execute(
+        cur = self.conn.execute(
             "SELECT 1 FROM bans WHERE room_id=? AND username=?", 
             (room_id, username)
         )
-        return self.cursor.fetchone() is not None
+        return cur.fetchone() is not None
 
     def get_deleted_message_log(self, room_id):
-        self.cursor.execute(
-            """SELECT dm.*, m.text FROM deleted_messages dm 
-               LEFT JOIN messages m ON dm.message_id = m.id 
-               WHERE EXISTS(SELECT 1 FROM messages WHERE id=dm.message_id AND target=?)""",
+        cur = self.conn.execute(
+            "SELECT * FROM deleted_messages WHERE target=? ORDER BY deleted_at DESC",
             (room_id,)
         )
-        return [dict(row) for row in self.cursor.fetchall()]
+        return [dict(row) for row in cur.fetchall()]
+
+
+# Read-only соединение текущего потока-читателя
+_reader = threading.local()
+
+def _open_reader(db_name, user_cache):
+    _reader.db = Database.open_reader(db_name, user_cache)
+
+def _read(name, args, kwargs):
+    return getattr(_reader.db, name)(*args, **kwargs)
+
+
+class AsyncDatabase:
+    """Асинхронная обёртка над Database.
+
+    Запись и лёгкие запросы выполняются в одном выделенном потоке: event
+    loop не блокируется на SQLite, а обращения к соединению остаются
+    последовательными. Тяжёлые выборки из READ_METHODS идут в пул
+    читателей со своими read-only соединениями - под WAL они не ждут
+    писателя и друг друга. Создаётся через AsyncDatabase.open.
+    """
+    READ_METHODS = frozenset({
+        "get_history", "get_thread_messages", "search_messages",
+        "get_rooms", "search_rooms", "search_users", "get_room_bundle",
+    })
+
+    def __init__(self, db, executor, readers):
+        self.db = db
+        self.executor = executor
+        self.readers = readers
+
+    @classmethod
+    async def open(cls, db_name):
+        """Открывает БД (включая init_db) прямо в потоке, которому принадлежит соединение"""
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        loop = asyncio.get_running_loop()
+        db = await loop.run_in_executor(executor, Database, db_name)
+        # Читатели открываются после init_db: read-only соединение не создаст таблицы
+        readers = ThreadPoolExecutor(max_workers=READER_THREADS, thread_name_prefix="sqlite-ro",
+                                     initializer=_open_reader, initargs=(db_name, db.user_cache))
+        return cls(db, executor, readers)
+
+    def __getattr__(self, name):
+        if name in self.READ_METHODS:
+            async def read(*args, **kwargs):
+                # Читатели видят только зафиксированное - сначала сбрасываем
+                # накопленные изменения, чтобы клиент увидел свои же сообщения
+                if self.db.pending_commit:
+                    await self.flush()
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(self.readers, _read, name, args, kwargs)
+            return read
+
+        method = getattr(self.db, name)
+
+        async def call(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, functools.partial(method, *args, **kwargs))
+        return call
 
 
 class ChatServer:
-    def __init__(self):
+    def __init__(self, db):
         self.clients = {}
-        self.db = Database(DB_NAME)
+        self.db = db
         self.user_last_seen = {}  # {username: timestamp}
-        self.spam_tracker = defaultdict(list)  # {username: [timestamps]}
+        self.last_online = set()  # кто был в сети при прошлой рассылке присутствия
+        self.auth_failures = defaultdict(lambda: deque(maxlen=AUTH_LIMIT))  # {ip: отметки неудачных входов}
+        self.auth_pruned = time.time()  # когда auth_failures последний раз чистился
+        self.hash_slots = asyncio.Semaphore(HASH_CONCURRENCY)
+        self.spam_buckets = {}  # {username: (токены, time.monotonic_ns() последнего сообщения)}
         self.last_activity = {}  # {username: timestamp}
-        
-        # Запуск фонового потока для запланированных сообщений
-        threading.Thread(target=self.scheduled_message_worker, daemon=True).start()
+        self.role_cache = {}  # {(room_id, username): роль или None}, см. user_role
+        self.avatars = {}  # {username: аватар} подключённых; меняется только через update_profile
+        self.room_members = defaultdict(set)  # {room_id: {username}}, зеркало room_members в БД
+        self.send_queues = {}  # {websocket: asyncio.Queue кадров}, см. send_frame и writer
+        self.static = load_static()  # {путь: (Content-Type, содержимое)}
+        self.presence_changed = set()  # кто сменил профиль с прошлой рассылки
+        self.presence_joined = set()  # кто подключился с прошлой рассылки
+        self.presence_dirty = asyncio.Event()  # есть что разослать, см. presence_worker
+        # Обработчики сообщений клиента по типу, кроме MESSAGE_TYPES (on_message)
+        self.handlers = {
+            "search_messages": self.on_search_messages,
+            "toggle_bookmark": self.on_toggle_bookmark,
+            "forward_msg": self.on_forward_msg,
+            "update_status": self.on_update_status,
+            "get_thread": self.on_get_thread,
+            "vote_poll": self.on_vote_poll,
+            "signal": self.on_signal,
+            "typing": self.on_typing,
+            "reaction": self.on_reaction,
+            "mark_read": self.on_mark_read,
+            "edit_msg": self.on_edit_msg,
+            "delete_msg": self.on_delete_msg,
+            "pin_msg": self.on_pin_msg,
+            "create_invite": self.on_create_invite,
+            "join_with_invite": self.on_join_with_invite,
+            "kick_user": self.on_kick_user,
+            "ban_user": self.on_ban_user,
+            "update_profile": self.on_update_profile,
+            "create_room": self.on_create_room,
+            "search_rooms": self.on_search_rooms,
+            "join_room": self.on_join_room,
+            "search_users": self.on_search_users,
+            "get_recent_contacts": self.on_get_recent_contacts,
+            "rename_room": self.on_rename_room,
+            "update_room_avatar": self.on_update_room_avatar,
+            "change_member_role": self.on_change_member_role,
+            "history_req": self.on_history_req,
+        }
 
     def is_spam(self, username):
-        """Проверка анти-спама"""
-        now = time.time()
-        self.spam_tracker[username] = [ts for ts in self.spam_tracker[username] 
-                                       if now - ts < SPAM_WINDOW]
-        
-        if len(self.spam_tracker[username]) >= SPAM_LIMIT:
+        """Проверка анти-спама корзиной токенов на SPAM_LIMIT сообщений за SPAM_WINDOW"""
+        now = time.monotonic_ns()
+        tokens, last = self.spam_buckets.get(username, (SPAM_CAPACITY, now))
+        tokens = min(SPAM_CAPACITY, tokens + (now - last) * SPAM_LIMIT)
+        if tokens < SPAM_COST:
             return True
-        
-        self.spam_tracker[username].append(now)
+        self.spam_buckets[username] = (tokens - SPAM_COST, now)
         return False
 
+    def auth_blocked(self, ip):
+        """Слишком много неудачных входов с этого IP за AUTH_WINDOW"""
+        recent = self.auth_failures.get(ip)
+        return bool(recent) and len(recent) == AUTH_LIMIT and time.time() - recent[0] < AUTH_WINDOW
+
+    def record_auth_failure(self, ip):
+        """Запоминает неудачный вход; не чаще раза в AUTH_WINDOW выбрасывает
+        IP, у которых последняя неудача старше окна"""
+        now = time.time()
+        self.auth_failures[ip].append(now)
+        if now - self.auth_pruned > AUTH_WINDOW:
+            self.auth_pruned = now
+            expired = [addr for addr, recent in self.auth_failures.items() if now - recent[-1] >= AUTH_WINDOW]
+            for addr in expired:
+                del self.auth_failures[addr]
+
+    async def run_hash(self, func, *args):
+        """scrypt в отдельном потоке, не больше HASH_CONCURRENCY одновременно"""
+        async with self.hash_slots:
+            return await asyncio.to_thread(func, *args)
+
+    async def check_login(self, username, password):
+        """Проверка пароля.
+
+        scrypt считается в отдельном потоке, а не в потоке БД, чтобы не
+        задерживать запросы остальных клиентов.
+        """
+        stored_hash = await self.db.get_password_hash(username)
+        ok = await self.run_hash(verify_password, password, stored_hash or DUMMY_HASH)
+        if not ok or stored_hash is None:
+            return False
+        # Старый sha256-хэш заменяем на scrypt при первом успешном входе
+        if not stored_hash.startswith("scrypt$"):
+            await self.db.set_password_hash(username, await self.run_hash(hash_password, password))
+        return True
+
+    async def user_role(self, room_id, username):
+        """Роль пользователя в комнате; кэшируется до смены состава или ролей"""
+        key = (room_id, username)
+        if key in self.role_cache:
+            return self.role_cache[key]
+        role = await self.db.get_user_role(room_id, username)
+        if len(self.role_cache) >= ROLE_CACHE_SIZE:
+            del self.role_cache[next(iter(self.role_cache))]
+        self.role_cache[key] = role
+        return role
+
+    async def load_room_members(self):
+        """Заполняет индекс участников комнат при запуске; дальше он
+        обновляется вместе с записью в room_members"""
+        for room_id, username in await self.db.get_memberships():
+            self.room_members[room_id].add(username)
+
     def check_content(self, text):
         """Проверка контента на запрещенные слова"""
-        text_lower = text.lower()
-        for word in BLOCKED_WORDS:
-            if word in text_lower:
-                return False
+        if BLOCKED_HS is None:
+            return BLOCKED_RE.search(text) is None
+        try:
+            BLOCKED_HS.scan(text.encode(), match_event_handler=_stop_scan)
+        except hyperscan.ScanTerminated:
+            return False
         return True
 
-    def scheduled_message_worker(self):
-        """Фоновый рабочий для отправки запланированных сообщений"""
+    async def commit_flusher(self):
+        """Периодически фиксирует накопленные изменения в БД"""
         while True:
-            time.sleep(10)  # проверка каждые 10 секунд
-            self.db.cursor.execute(
-                "SELECT * FROM scheduled_messages WHERE sent=0 AND scheduled_time <= ?",
-                (time.time(),)
-            )
-            for row in self.db.cursor.fetchall():
-                # Здесь можно добавить логику отправки
-                self.db.cursor.execute(
-                    "UPDATE scheduled_messages SET sent=1 WHERE id=?",
-                    (row['id'],)
-                )
-                self.db.conn.commit()
+            await asyncio.sleep(COMMIT_INTERVAL)
+            try:
+                if self.db.db.pending_commit:
+                    await self.db.flush()
+            except Exception:
+                # Следующий тик повторит фиксацию
+                log.exception("Commit error")
+
+    async def scheduler(self):
+        """Отправка запланированных сообщений.
+
+        Спит до ближайшего scheduled_time, а не опрашивает таблицу по таймеру;
+        без очереди просыпается раз в SCHEDULER_IDLE.
+        """
+        while True:
+            try:
+                next_time = await self.db.next_scheduled_time()
+                delay = SCHEDULER_IDLE if next_time is None else next_time - time.time()
+                if delay > 0:
+                    await asyncio.sleep(min(delay, SCHEDULER_IDLE))
+                    continue
+                await self.db.process_scheduled_messages()
+            except Exception:
+                log.exception("Scheduler error")
+                await asyncio.sleep(SCHEDULER_IDLE)
+
+    def send_frame(self, targets, frame):
+        """Ставит готовый кадр в очереди соединений, не дожидаясь отправки.
+
+        Медленный получатель не задерживает отправителя и остальных: кадры
+        ему отправляет его writer. Соединение, у которого в очереди уже
+        SEND_QUEUE_SIZE кадров, обрывается, чтобы клиент переподключился и
+        получил состояние заново.
+        """
+        for ws in targets:
+            queue = self.send_queues.get(ws)
+            if queue is None:
+                continue
+            try:
+                queue.put_nowait(frame)
+            except asyncio.QueueFull:
+                if not ws.transport.is_closing():
+                    log.warning("[!] %s: send queue overflow, dropping slow client", ws.remote_address)
+                    ws.transport.abort()
+
+    async def writer(self, websocket, queue):
+        """Отправляет кадры из очереди соединения по одному"""
+        try:
+            while True:
+                await websocket.send(await queue.get())
+        except websockets.ConnectionClosed:
+            pass
 
     async def broadcast(self, message, exclude=None):
         if not self.clients: return
-        msg_json = json.dumps(message)
-        recipients = [ws for ws in self.clients.values() if ws != exclude]
-        if recipients:
-            await asyncio.gather(*[ws.send(msg_json) for ws in recipients], return_exceptions=True)
+        # Сообщение сериализуется один раз и пишется во все соединения
+        # без корутины на каждое
+        self.send_frame((ws for ws in self.clients.values() if ws is not exclude), dumps(message))
+
+    async def broadcast_room(self, room_id, message, exclude=None):
+        """Рассылка участникам комнаты, которые сейчас в сети; состав берётся
+        из индекса в памяти, без запроса к БД"""
+        online = self.room_members.get(room_id, set()) & self.clients.keys()
+        if not online: return
+        self.send_frame((ws for ws in map(self.clients.get, online) if ws is not exclude), dumps(message))
 
     async def send_to_user(self, nick, message):
         if nick in self.clients:
-            await self.clients[nick].send(json.dumps(message))
-
-    async def broadcast_presence(self):
-        online_users = list(self.clients.keys())
-        for user, ws in self.clients.items():
-            contacts_list = self.db.get_contacts(user)
-            final_list = []
-            processed = set()
-            for contact_nick in contacts_list:
-                processed.add(contact_nick)
-                u_info = self.db.get_user_info(contact_nick)
-                if u_info:
-                    final_list.append({
-                        "nick": contact_nick,
-                        "avatar": u_info['avatar'],
-                        "bio": u_info['bio'],
-                        "user_status": u_info['user_status'],
-                        "online": contact_nick in online_users,
-                        "last_seen": self.user_last_seen.get(contact_nick)
-                    })
-            for on_user in online_users:
-                if on_user not in processed and on_user != user:
-                    u_info = self.db.get_user_info(on_user)
-                    if u_info:
-                        final_list.append({
-                            "nick": on_user,
-                            "avatar": u_info['avatar'],
-                            "bio": u_info['bio'],
-                            "user_status": u_info['user_status'],
-                            "online": True,
-                            "last_seen": None
-                        })
-            await ws.send(json.dumps({"type": "contacts_list", "users": final_list}))
+            self.send_frame((self.clients[nick],), dumps(message))
+
+    async def send_to_users(self, nicks, message):
+        """Отправляет одно сообщение нескольким пользователям, сериализуя его один раз"""
+        self.send_frame([self.clients[n] for n in set(nicks) if n in self.clients], dumps(message))
+
+    async def send_room_update(self, room_id, **changes):
+        """Сообщает участникам комнаты об изменённых полях одним общим сообщением,
+        вместо того чтобы пересобирать каждому его список комнат"""
+        await self.broadcast_room(room_id, {"type": "room_updated", "id": room_id, "changes": changes})
+
+    def presence_entry(self, nick, profile, online):
+        return {
+            "nick": nick,
+            "avatar": profile['avatar'],
+            "bio": profile['bio'],
+            "user_status": profile['user_status'],
+            "online": online,
+            "last_seen": self.user_last_seen.get(nick)
+        }
+
+    def schedule_presence(self, changed=(), joined=()):
+        """Отмечает изменение присутствия; рассылку сделает presence_worker"""
+        self.presence_changed.update(changed)
+        self.presence_joined.update(joined)
+        self.presence_dirty.set()
+
+    async def presence_worker(self):
+        """Рассылает присутствие не чаще раза в PRESENCE_DELAY.
+
+        Входы, выходы и смены профиля, пришедшие за это время, уходят одной
+        рассылкой вместо отдельной на каждое событие.
+        """
+        while True:
+            await self.presence_dirty.wait()
+            await asyncio.sleep(PRESENCE_DELAY)
+            self.presence_dirty.clear()
+            changed, self.presence_changed = self.presence_changed, set()
+            joined, self.presence_joined = self.presence_joined, set()
+            try:
+                await self.broadcast_presence(changed, joined)
+            except Exception:
+                log.exception("Presence error")
+
+    async def broadcast_presence(self, changed=(), joined=()):
+        """Рассылает изменения присутствия.
+
+        Полный contacts_list получают только новые подключения (в том числе
+        переподключившиеся между рассылками - joined), остальным уходит
+        presence_delta: кто вошёл, вышел или сменил профиль (changed).
+        Профили загружаются одним запросом на вызов, а не по запросу на пару
+        пользователей.
+        """
+        online = set(self.clients)
+        joined = (online - self.last_online) | (online & set(joined))
+        left = self.last_online - online
+        self.last_online = online
+
+        contacts = {user: await self.db.get_contacts(user) for user in joined}
+        need = set(changed) | joined
+        for user_contacts in contacts.values():
+            need.update(user_contacts)
+        profiles = await self.db.get_user_profiles(list(need)) if need else {}
+        # Профили тех, кто в сети, нужны новым подключениям целиком
+        if joined:
+            profiles.update(await self.db.get_user_profiles(list(online - profiles.keys())))
+
+        for user in joined:
+            ws = self.clients.get(user)
+            if ws is None:
+                continue
+            final_list = [self.presence_entry(c, profiles[c], c in online)
+                          for c in contacts[user] if c in profiles]
+            listed = set(contacts[user])
+            final_list.extend(self.presence_entry(u, profiles[u], True)
+                              for u in online if u not in listed and u != user and u in profiles)
+            self.send_frame((ws,), dumps({"type": "contacts_list", "users": final_list}))
+
+        now = time.time()
+        delta = [{"nick": nick, "online": False, "last_seen": now} for nick in left]
+        delta.extend(self.presence_entry(nick, profiles[nick], nick in online)
+                     for nick in (joined | set(changed)) if nick in profiles)
+        if delta:
+            self.send_frame([ws for user, ws in self.clients.items() if user not in joined],
+                            dumps({"type": "presence_delta", "users": delta}))
+
+    async def process_request(self, path, request_headers):
+        """Отдаёт по HTTP клиент и вложения; остальные запросы идут в WebSocket-рукопожатие"""
+        match = MEDIA_PATH_RE.match(path)
+        if not match:
+            static = self.static.get(path.split("?", 1)[0])
+            if static is None or request_headers.get("Upgrade", "").lower() == "websocket":
+                return None
+            content_type, body = static
+            return HTTPStatus.OK, [("Content-Type", content_type), ("Cache-Control", "no-cache")], body
+        try:
+            body = await asyncio.to_thread(_read_media, match.group(1))
+        except FileNotFoundError:
+            return HTTPStatus.NOT_FOUND, [], b""
+        return HTTPStatus.OK, [
+            ("Content-Type", "application/octet-stream"),
+            ("Cache-Control", "public, max-age=31536000, immutable"),
+            ("Access-Control-Allow-Origin", "*"),
+        ], body
 
     async def handler(self, websocket):
         nick = None
+        writer = None
         try:
             # AUTH
             msg_str = await asyncio.wait_for(websocket.recv(), timeout=60)
-            auth_data = json.loads(msg_str)
+            auth_data = orjson.loads(msg_str)
             
             if auth_data.get('type') == 'auth_req':
                 username = auth_data['username']
@@ -730,22 +1474,29 @@ class ChatServer:
                 action = auth_data['action']
 
                 if not NICK_RE.match(username):
-                    await websocket.send(json.dumps({"type": "auth_error", "text": "Ник некорректен."}))
+                    await websocket.send(AUTH_ERR_NICK)
+                    return
+
+                ip = client_ip(websocket)
+                if self.auth_blocked(ip):
+                    await asyncio.sleep(AUTH_FAIL_DELAY)
+                    await websocket.send(AUTH_ERR_THROTTLED)
                     return
 
                 success = False
                 if action == 'register': 
-                    success = self.db.register_user(username, password)
+                    password_hash = await self.run_hash(hash_password, password)
+                    success = await self.db.register_user(username, password_hash)
                 elif action == 'login': 
-                    success = self.db.check_login(username, password)
+                    success = await self.check_login(username, password)
 
                 if success:
                     if action == 'login' and username in self.clients:
-                         await websocket.send(json.dumps({"type": "auth_error", "text": "Уже в сети."}))
+                         await websocket.send(AUTH_ERR_ONLINE)
                          return
                     
-                    profile = self.db.get_user_info(username)
-                    await websocket.send(json.dumps({
+                    profile = await self.db.get_user_info(username)
+                    await websocket.send(dumps({
                         "type": "auth_success", 
                         "nick": username, 
                         "avatar": profile['avatar'], 
@@ -754,403 +1505,455 @@ class ChatServer:
                     }))
                     nick = username
                     self.clients[nick] = websocket
+                    self.send_queues[websocket] = asyncio.Queue(SEND_QUEUE_SIZE)
+                    writer = asyncio.create_task(self.writer(websocket, self.send_queues[websocket]))
+                    self.avatars[nick] = profile['avatar']
                     self.user_last_seen[nick] = time.time()
-                    print(f"[+] {nick} connected")
+                    log.info("[+] %s connected", nick)
                 else:
-                    await websocket.send(json.dumps({"type": "auth_error", "text": "Ошибка входа."}))
+                    self.record_auth_failure(ip)
+                    await asyncio.sleep(AUTH_FAIL_DELAY)
+                    await websocket.send(AUTH_ERR_FAILED)
                     return
             else:
                 return
 
-            await websocket.send(json.dumps({"type": "rooms_list", "rooms": self.db.get_rooms(nick)}))
-            await self.broadcast_presence()
+            await websocket.send(dumps({"type": "rooms_list", "rooms": await self.db.get_rooms(nick)}))
+            self.schedule_presence(joined=[nick])
 
             # MAIN LOOP
             async for message_str in websocket:
-                data = json.loads(message_str)
+                if isinstance(message_str, bytes):
+                    # Бинарный кадр без заголовка "upload" - игнорируем
+                    continue
+                data = orjson.loads(message_str)
                 mtype = data.get("type")
+                # Содержимое вложения клиент присылает следующим бинарным
+                # кадром, без base64; читаем его сразу, даже если сообщение
+                # потом будет отклонено
+                upload = await websocket.recv() if data.pop("upload", None) else None
                 
                 if "text" in data and data["text"]: 
-                    data["text"] = html.escape(data["text"])
+                    data["text"] = escape_html(data["text"])
+                if data.get("filename"):
+                    data["filename"] = escape_html(data["filename"])
 
                 # Обновить last_seen
                 self.user_last_seen[nick] = time.time()
 
-                # Анти-спам проверка
-                if mtype in ["msg", "image", "video", "audio", "file", "poll"]:
-                    if self.is_spam(nick):
-                        await websocket.send(json.dumps({
-                            "type": "error", 
-                            "text": "Вы отправляете слишком много сообщений"
-                        }))
-                        continue
-
-                if mtype in ["msg", "image", "video", "audio", "file", "poll", "sticker"]:
-                    # Проверка контента
-                    if data.get("text") and not self.check_content(data["text"]):
-                        await websocket.send(json.dumps({
-                            "type": "error", 
-                            "text": "Сообщение содержит недопустимый контент"
-                        }))
-                        continue
-                    
-                    # Проверка: нельзя писать самому себе
-                    if 'recipient' in data and data['recipient'] == nick:
-                        await websocket.send(json.dumps({"type": "error", "text": "Нельзя писать сообщения самому себе"}))
-                        continue
-                    
-                    if 'room_name' in data and self.db.is_banned(data['room_name'], nick):
-                        await websocket.send(json.dumps({"type": "error", "text": "Вы забанены в этой группе."}))
-                        continue
-                    
-                    if 'room_name' in data:
-                        info = self.db.get_room_info(data['room_name'])
-                        role = self.db.get_user_role(data['room_name'], nick)
-                        if info and info['type'] == 'channel' and role not in ['admin']:
-                            continue
-
-                    data['sender'] = nick
-                    data['timestamp'] = time.time()
-                    u_info = self.db.get_user_info(nick)
-                    data['sender_avatar'] = u_info['avatar'] if u_info else None
-                    data['is_read'] = 0
-                    data['is_edited'] = 0
-
-                    if mtype == "poll": 
-                        data['poll_results'] = {}
-
-                    msg_id = self.db.save_message(data)
-                    data['id'] = msg_id
-                    data['reactions'] = {}
-
-                    if 'room_name' in data: 
-                        await self.broadcast(data)
-                    elif 'recipient' in data:
-                        await self.send_to_user(data['recipient'], data)
-                        await websocket.send(json.dumps(data))
-
-                # --- ПОИСК СООБЩЕНИЙ ---
-                elif mtype == "search_messages":
-                    results = self.db.search_messages(
-                        data['context'],
-                        data['target'],
-                        nick,
-                        data.get('query', ''),
-                        data.get('start_date'),
-                        data.get('end_date'),
-                        data.get('limit', 100)
-                    )
-                    await websocket.send(json.dumps({
-                        "type": "search_results",
-                        "results": results
-                    }))
-
-                # --- ЗАКЛАДКИ ---
-                elif mtype == "toggle_bookmark":
-                    self.db.toggle_bookmark(nick, data['message_id'])
-                    await websocket.send(json.dumps({
-                        "type": "bookmark_toggled",
-                        "id": data['message_id']
-                    }))
-
-                # --- ПЕРЕСЫЛКА СООБЩЕНИЯ ---
-                elif mtype == "forward_msg":
-                    orig_msg = self.db.get_message(data['message_id'])
-                    if orig_msg:
-                        fwd_data = {
-                            "type": data['target_type'],
-                            "sender": nick,
-                            "text": f"[Пересланное] {orig_msg['text']}",
-                            "timestamp": time.time(),
-                            "sender_avatar": self.db.get_user_info(nick)['avatar']
-                        }
-                        if data['target_type'] == 'room':
-                            fwd_data['room_name'] = data['target']
-                            await self.broadcast(fwd_data)
-                        else:
-                            fwd_data['recipient'] = data['target']
-                            await self.send_to_user(data['target'], fwd_data)
-                            await websocket.send(json.dumps(fwd_data))
-
-                # --- СТАТУС ПОЛЬЗОВАТЕЛЯ ---
-                elif mtype == "update_status":
-                    self.db.update_user_status(nick, data.get('status', ''))
-                    await self.broadcast_presence()
-
-                # --- THREADS ---
-                elif mtype == "get_thread":
-                    thread_msgs = self.db.get_thread_messages(data['thread_id'])
-                    await websocket.send(json.dumps({
-                        "type": "thread_messages",
-                        "messages": thread_msgs
-                    }))
-
-                # --- POLL VOTE ---
-                elif mtype == "vote_poll":
-                    results = self.db.vote_poll(data['message_id'], nick, data['option_index'])
-                    update = {"type": "poll_update", "id": data['message_id'], "results": results}
-                    
-                    if 'room_name' in data: 
-                        await self.broadcast(update)
-                    elif 'recipient' in data:
-                        sender = self.db.get_message(data['message_id'])['sender']
-                        await self.send_to_user(sender, update)
-                        await self.send_to_user(data['recipient'], update)
-                        await websocket.send(json.dumps(update))
-
-                # --- WEBRTC SIGNALING ---
-                elif mtype == "signal":
-                    payload = {
-                        "type": "signal",
-                        "sender": nick,
-                        "sender_avatar": self.db.get_user_info(nick)['avatar'],
-                        "data": data['data']
-                    }
-                    if 'room_name' in data:
-                        payload['room_name'] = data['room_name']
-                        await self.broadcast(payload, exclude=websocket)
-                    elif 'target' in data:
-                        await self.send_to_user(data['target'], payload)
-
-                elif mtype == "typing":
-                    if 'room_name' in data: 
-                        await self.broadcast(data, exclude=websocket)
-                    elif 'recipient' in data: 
-                        await self.send_to_user(data['recipient'], data)
-
-                elif mtype == "reaction":
-                    new_r = self.db.toggle_reaction(data['message_id'], nick, data['emoji'])
-                    await self.broadcast({"type": "reaction_update", "id": data['message_id'], "reactions": new_r})
-
-                elif mtype == "mark_read":
-                    if self.db.mark_read(data['sender'], nick):
-                        await self.send_to_user(data['sender'], {"type": "msgs_read_by_user", "reader": nick})
-
-                elif mtype == "edit_msg":
-                    if self.db.edit_message(data['id'], nick, data['text']):
-                        upd = {"type": "msg_edited", "id": data['id'], "text": data['text']}
-                        if 'room_name' in data: 
-                            await self.broadcast(upd)
-                        else:
-                            await self.send_to_user(data['recipient'], upd)
-                            await websocket.send(json.dumps(upd))
-
-                elif mtype == "delete_msg":
-                    is_admin = False
-                    if 'room_name' in data:
-                        role = self.db.get_user_role(data['room_name'], nick)
-                        if role in ['admin', 'moderator']: 
-                            is_admin = True
-                    
-                    if self.db.delete_message(data['id'], nick, is_admin, data.get('reason', '')):
-                        upd = {"type": "msg_deleted", "id": data['id']}
-                        if 'room_name' in data: 
-                            await self.broadcast(upd)
-                        else:
-                            await self.send_to_user(data['recipient'], upd)
-                            await websocket.send(json.dumps(upd))
-
-                elif mtype == "pin_msg":
-                    role = self.db.get_user_role(data['room_name'], nick)
-                    if role in ['admin']:
-                        self.db.pin_message(data['room_name'], data['id'])
-                        pinned_msg = self.db.get_message(data['id'])
-                        await self.broadcast({
-                            "type": "pinned_update", 
-                            "room_name": data['room_name'], 
-                            "msg": pinned_msg
-                        })
-
-                elif mtype == "create_invite":
-                    role = self.db.get_user_role(data['room_name'], nick)
-                    if role in ['admin', 'moderator']:
-                        code = self.db.create_invite_code(data['room_name'], nick)
-                        if code:
-                            await websocket.send(json.dumps({
-                                "type": "invite_created",
-                                "code": code,
-                                "link": f"join/{code}"
-                            }))
-
-                elif mtype == "join_with_invite":
-                    room_name, status = self.db.use_invite_code(data['code'], nick)
-                    await websocket.send(json.dumps({
-                        "type": "join_result",
-                        "success": status == "OK",
-                        "room_name": room_name,
-                        "message": status
-                    }))
-                    if status == "OK":
-                        await self.broadcast_presence()
-
-                elif mtype == "kick_user":
-                    role = self.db.get_user_role(data['room_name'], nick)
-                    if role in ['admin']:
-                        await self.broadcast({
-                            "type": "info", 
-                            "text": f"{data['user']} кикнут из {data['room_name']}"
-                        })
-
-                elif mtype == "ban_user":
-                    role = self.db.get_user_role(data['room_name'], nick)
-                    if role in ['admin']:
-                        self.db.ban_user(data['room_name'], data['user'])
-                        await self.broadcast({
-                            "type": "info", 
-                            "text": f"{data['user']} забанен в {data['room_name']}"
-                        })
-
-                elif mtype == "update_profile":
-                    self.db.update_profile(nick, data['avatar'], html.escape(data['bio']))
-                    await self.broadcast_presence()
-                    await websocket.send(json.dumps({"type": "info", "text": "Профиль обновлен"}))
-
-                elif mtype == "create_room":
-                    if self.db.create_room(html.escape(data['name']), nick, data['rtype']):
-                        # Send updated rooms list only to the user who created the room
-                        await websocket.send(json.dumps({"type": "rooms_list", "rooms": self.db.get_rooms(nick)}))
-
-                elif mtype == "search_rooms":
-                    query = data.get('query', '').strip()
-                    if query:
-                        results = self.db.search_rooms(query)
-                        # Check which ones user is already member of
-                        for room in results:
-                            is_member = self.db.cursor.execute(
-                                "SELECT 1 FROM room_members WHERE room_id=? AND username=?",
-                                (room['id'], nick)
-                            ).fetchone() is not None
-                            room['is_member'] = is_member
-                        await websocket.send(json.dumps({"type": "search_results", "results": results}))
-
-                elif mtype == "join_room":
-                    room_id = data.get('room_id')
-                    if self.db.join_room(room_id, nick):
-                        # Send confirmation and updated rooms list
-                        await websocket.send(json.dumps({
-                            "type": "room_joined",
-                            "room_id": room_id,
-                            "message": "Вы присоединились к группе"
-                        }))
-                        await websocket.send(json.dumps({
-                            "type": "rooms_list",
-                            "rooms": self.db.get_rooms(nick)
-                        }))
-                    else:
-                        await websocket.send(json.dumps({
-                            "type": "error",
-                            "text": "Не удалось присоединиться к группе"
-                        }))
-
-                elif mtype == "search_users":
-                    query = data.get('query', '').strip()
-                    if query:
-                        # Исключаем текущего пользователя из результатов
-                        results = self.db.search_users(query, exclude_username=nick)
-                        await websocket.send(json.dumps({"type": "search_users_results", "results": results}))
-
-                elif mtype == "get_recent_contacts":
-                    contacts = self.db.get_recent_contacts(nick)
-                    await websocket.send(json.dumps({"type": "recent_contacts", "contacts": contacts}))
-
-                elif mtype == "rename_room":
-                    role = self.db.get_user_role(data['room_name'], nick)
-                    if role in ['admin']:
-                        # Обновляем только название, ID остаётся прежним
-                        self.db.cursor.execute("UPDATE rooms SET name=? WHERE id=?", 
-                                              (data['new_name'], data['room_name']))
-                        self.db.conn.commit()
-                        # Send updated rooms list to all connected clients
-                        for client_nick in self.clients:
-                            await self.clients[client_nick].send(json.dumps({
-                                "type": "rooms_list",
-                                "rooms": self.db.get_rooms(client_nick)
-                            }))
-                elif mtype == "update_room_avatar":
-                    role = self.db.get_user_role(data['room_name'], nick)
-                    if role in ['admin']:
-                        # Сохраняем аватар в БД
-                        self.db.cursor.execute("UPDATE rooms SET avatar=? WHERE id=?", 
-                                              (data['avatar'], data['room_name']))
-                        self.db.conn.commit()
-                        # Send updated rooms list to all connected clients
-                        for client_nick in self.clients:
-                            await self.clients[client_nick].send(json.dumps({
-                                "type": "rooms_list",
-                                "rooms": self.db.get_rooms(client_nick)
-                            }))
-
-                elif mtype == "change_member_role":
-                    role = self.db.get_user_role(data['room_name'], nick)
-                    if role in ['admin']:
-                        self.db.cursor.execute("UPDATE room_members SET role=? WHERE room_id=? AND username=?",
-                                              (data['role'], data['room_name'], data['username']))
-                        self.db.conn.commit()
-                        await self.broadcast({
-                            "type": "info",
-                            "text": f"Роль {data['username']} в группе {data['room_name']} изменена на {data['role']}"
-                        })
-
-                elif mtype == "history_req":
-                    context = data['context']
-                    target = data['target']
-                    if context == 'pm':
-                        self.db.mark_read(target, nick)
-                        await self.send_to_user(target, {"type": "msgs_read_by_user", "reader": nick})
-                    hist = self.db.get_history(context, target, nick)
-                    room_info = self.db.get_room_info(target) if context == 'room' else None
-                    
-                    # Добавить информацию о членах группы и количество участников
-                    if room_info:
-                        members = self.db.get_room_members(target)
-                        room_info['members'] = members
-                        room_info['member_count'] = len(members)
-                    
-                    pinned = None
-                    if room_info and room_info['pinned_msg_id']:
-                        pinned = self.db.get_message(room_info['pinned_msg_id'])
-                    await websocket.send(json.dumps({
-                        "type": "history", "history": hist, "context": context, "target": target, 
-                        "room_info": room_info, "pinned": pinned
-                    }))
+                # Тип сообщения выбирает обработчик поиском в словаре, а не
+                # перебором веток if/elif
+                if mtype in MESSAGE_TYPES:
+                    await self.on_message(websocket, nick, data, upload)
+                else:
+                    handler = self.handlers.get(mtype)
+                    if handler:
+                        await handler(websocket, nick, data)
 
         except websockets.ConnectionClosed: 
             pass
-        except Exception as e: 
-            print(f"Err {nick}: {e}")
+        except Exception: 
+            log.exception("Err %s", nick)
         finally:
+            if writer:
+                writer.cancel()
+            self.send_queues.pop(websocket, None)
             if nick in self.clients: 
                 del self.clients[nick]
             if nick in self.user_last_seen:
                 del self.user_last_seen[nick]
-            await self.broadcast_presence()
-            print(f"[-] {nick} disconnected")
+            self.avatars.pop(nick, None)
+            self.schedule_presence()
+            log.info("[-] %s disconnected", nick)
+
+    async def on_message(self, websocket, nick, data, upload):
+        """Сообщение в комнату или личку: msg, вложения, опрос, стикер.
+        upload - содержимое вложения из бинарного кадра, если оно было"""
+        mtype = data['type']
+        # Анти-спам проверка (стикеры не считаются)
+        if mtype != "sticker" and self.is_spam(nick):
+            await websocket.send(ERR_SPAM)
+            return
+
+        # Проверка контента
+        if data.get("text") and not self.check_content(data["text"]):
+            await websocket.send(ERR_CONTENT)
+            return
+
+        # Проверка: нельзя писать самому себе
+        if 'recipient' in data and data['recipient'] == nick:
+            await websocket.send(ERR_SELF)
+            return
+
+        if 'room_name' in data and await self.db.is_banned(data['room_name'], nick):
+            await websocket.send(ERR_BANNED)
+            return
+
+        if 'room_name' in data:
+            info = await self.db.get_room_info(data['room_name'])
+            role = await self.user_role(data['room_name'], nick)
+            if info and info['type'] == 'channel' and role not in ['admin']:
+                return
+
+        data['sender'] = nick
+        data['timestamp'] = now_ms()
+        data['sender_avatar'] = self.avatars[nick]
+        data['is_read'] = 0
+        data['is_edited'] = 0
+
+        if mtype == "poll": 
+            data['poll_results'] = {}
+
+        if mtype in MEDIA_TYPES and (upload is not None or data.get('data')):
+            try:
+                if isinstance(upload, bytes):
+                    data['data'] = await asyncio.to_thread(store_media, upload)
+                elif upload is not None:
+                    raise ValueError("upload must be a binary frame")
+                else:
+                    data['data'] = await asyncio.to_thread(store_media_b64, data['data'])
+            # TypeError - data не строка (число, список, объект);
+            # OSError - не удалось записать файл
+            except (ValueError, TypeError, OSError):
+                await websocket.send(ERR_MEDIA)
+                return
+
+        msg_id = await self.db.save_message(data)
+        data['id'] = msg_id
+        data['data'] = media_path(data.get('data'))
+        data['reactions'] = {}
+
+        if 'room_name' in data: 
+            await self.broadcast_room(data['room_name'], data)
+        elif 'recipient' in data:
+            await self.send_to_users([data['recipient'], nick], data)
+
+    # --- ПОИСК СООБЩЕНИЙ ---
+    async def on_search_messages(self, websocket, nick, data):
+        results = await self.db.search_messages(
+            data['context'],
+            data['target'],
+            nick,
+            data.get('query', ''),
+            data.get('start_date'),
+            data.get('end_date'),
+            data.get('limit', 100)
+        )
+        await websocket.send(dumps({
+            "type": "search_results",
+            "results": results
+        }))
+
+    # --- ЗАКЛАДКИ ---
+    async def on_toggle_bookmark(self, websocket, nick, data):
+        await self.db.toggle_bookmark(nick, data['message_id'])
+        await websocket.send(dumps({
+            "type": "bookmark_toggled",
+            "id": data['message_id']
+        }))
+
+    # --- ПЕРЕСЫЛКА СООБЩЕНИЯ ---
+    async def on_forward_msg(self, websocket, nick, data):
+        orig_msg = await self.db.get_message(data['message_id'])
+        if orig_msg:
+            fwd_data = {
+                "type": data['target_type'],
+                "sender": nick,
+                "text": f"[Пересланное] {orig_msg['text']}",
+                "timestamp": now_ms(),
+                "sender_avatar": self.avatars[nick]
+            }
+            if data['target_type'] == 'room':
+                fwd_data['room_name'] = data['target']
+                await self.broadcast_room(data['target'], fwd_data)
+            else:
+                fwd_data['recipient'] = data['target']
+                await self.send_to_users([data['target'], nick], fwd_data)
+
+    # --- СТАТУС ПОЛЬЗОВАТЕЛЯ ---
+    async def on_update_status(self, websocket, nick, data):
+        await self.db.update_user_status(nick, escape_html(data.get('status', '')[:BIO_MAX_LEN]))
+        self.schedule_presence(changed=[nick])
+
+    # --- THREADS ---
+    async def on_get_thread(self, websocket, nick, data):
+        thread_msgs = await self.db.get_thread_messages(data['thread_id'], nick)
+        await websocket.send(dumps({
+            "type": "thread_messages",
+            "messages": thread_msgs
+        }))
+
+    # --- POLL VOTE ---
+    async def on_vote_poll(self, websocket, nick, data):
+        results = await self.db.vote_poll(data['message_id'], nick, data['option_index'])
+        update = {"type": "poll_update", "id": data['message_id'], "results": results}
+
+        if 'room_name' in data: 
+            await self.broadcast_room(data['room_name'], update)
+        elif 'recipient' in data:
+            sender = (await self.db.get_message(data['message_id']))['sender']
+            await self.send_to_users([sender, data['recipient'], nick], update)
+
+    # --- WEBRTC SIGNALING ---
+    async def on_signal(self, websocket, nick, data):
+        payload = {
+            "type": "signal",
+            "sender": nick,
+            "sender_avatar": self.avatars[nick],
+            "data": data['data']
+        }
+        if 'room_name' in data:
+            payload['room_name'] = data['room_name']
+            await self.broadcast_room(data['room_name'], payload, exclude=websocket)
+        elif 'target' in data:
+            await self.send_to_user(data['target'], payload)
+
+    async def on_typing(self, websocket, nick, data):
+        if 'room_name' in data: 
+            await self.broadcast_room(data['room_name'], data, exclude=websocket)
+        elif 'recipient' in data: 
+            await self.send_to_user(data['recipient'], data)
+
+    async def on_reaction(self, websocket, nick, data):
+        # Клиент вставляет реакцию и в разметку, и в onclick - экранирования
+        # сущностями там мало
+        emoji = data['emoji']
+        if not isinstance(emoji, str) or len(emoji) > EMOJI_MAX_LEN or _UNSAFE_RE.search(emoji):
+            return
+        msg = await self.db.get_message(data['message_id'])
+        if not msg:
+            return
+        new_r = await self.db.toggle_reaction(data['message_id'], nick, emoji)
+        upd = {"type": "reaction_update", "id": data['message_id'], "reactions": new_r}
+        # Обновление получают только те, кто видит сообщение
+        if msg['context'] == 'room':
+            await self.broadcast_room(msg['target'], upd)
+        else:
+            await self.send_to_users([msg['sender'], msg['target']], upd)
+
+    async def on_mark_read(self, websocket, nick, data):
+        if await self.db.mark_read(data['sender'], nick):
+            await self.send_to_user(data['sender'], {"type": "msgs_read_by_user", "reader": nick})
+
+    async def on_edit_msg(self, websocket, nick, data):
+        if await self.db.edit_message(data['id'], nick, data['text']):
+            upd = {"type": "msg_edited", "id": data['id'], "text": data['text']}
+            if 'room_name' in data: 
+                await self.broadcast_room(data['room_name'], upd)
+            else:
+                await self.send_to_users([data['recipient'], nick], upd)
+
+    async def on_delete_msg(self, websocket, nick, data):
+        is_admin = False
+        if 'room_name' in data:
+            role = await self.user_role(data['room_name'], nick)
+            if role in ['admin', 'moderator']: 
+                is_admin = True
+
+        if await self.db.delete_message(data['id'], nick, is_admin, data.get('reason', '')):
+            upd = {"type": "msg_deleted", "id": data['id']}
+            if 'room_name' in data: 
+                await self.broadcast_room(data['room_name'], upd)
+            else:
+                await self.send_to_users([data['recipient'], nick], upd)
+
+    async def on_pin_msg(self, websocket, nick, data):
+        role = await self.user_role(data['room_name'], nick)
+        if role in ['admin']:
+            await self.db.pin_message(data['room_name'], data['id'])
+            pinned_msg = await self.db.get_formatted_message(data['id'])
+            await self.broadcast_room(data['room_name'], {
+                "type": "pinned_update", 
+                "room_name": data['room_name'], 
+                "msg": pinned_msg
+            })
+
+    async def on_create_invite(self, websocket, nick, data):
+        role = await self.user_role(data['room_name'], nick)
+        if role in ['admin', 'moderator']:
+            code = await self.db.create_invite_code(data['room_name'], nick)
+            if code:
+                await websocket.send(dumps({
+                    "type": "invite_created",
+                    "code": code,
+                    "link": f"join/{code}"
+                }))
+
+    async def on_join_with_invite(self, websocket, nick, data):
+        room_name, status = await self.db.use_invite_code(data['code'], nick)
+        self.role_cache.pop((room_name, nick), None)
+        if status == "OK":
+            self.room_members[room_name].add(nick)
+        await websocket.send(dumps({
+            "type": "join_result",
+            "success": status == "OK",
+            "room_name": room_name,
+            "message": status
+        }))
+        if status == "OK":
+            room = await self.db.get_room(room_name)
+            if room:
+                await websocket.send(dumps({"type": "room_added", "room": room}))
+            # Новые соседи по группе - пересобираем его contacts_list
+            self.schedule_presence(joined=[nick])
+
+    async def on_kick_user(self, websocket, nick, data):
+        role = await self.user_role(data['room_name'], nick)
+        if role in ['admin']:
+            await self.broadcast_room(data['room_name'], {
+                "type": "info", 
+                "text": f"{data['user']} кикнут из {data['room_name']}"
+            })
+            # Сообщение о кике он ещё получит, дальнейшую рассылку группы - нет
+            await self.db.remove_room_member(data['room_name'], data['user'])
+            self.role_cache.pop((data['room_name'], data['user']), None)
+            self.room_members[data['room_name']].discard(data['user'])
+
+    async def on_ban_user(self, websocket, nick, data):
+        role = await self.user_role(data['room_name'], nick)
+        if role in ['admin']:
+            await self.db.ban_user(data['room_name'], data['user'])
+            await self.broadcast_room(data['room_name'], {
+                "type": "info", 
+                "text": f"{data['user']} забанен в {data['room_name']}"
+            })
+            self.room_members[data['room_name']].discard(data['user'])
+
+    async def on_update_profile(self, websocket, nick, data):
+        await self.db.update_profile(nick, data['avatar'], escape_html(data['bio'][:BIO_MAX_LEN]))
+        self.avatars[nick] = data['avatar']
+        self.schedule_presence(changed=[nick])
+        await websocket.send(INFO_PROFILE)
+
+    async def on_create_room(self, websocket, nick, data):
+        room_id = await self.db.create_room(escape_html(data['name'][:ROOM_NAME_MAX_LEN]), nick, data['rtype'])
+        if room_id:
+            self.role_cache.pop((room_id, nick), None)
+            self.room_members[room_id].add(nick)
+            # Send the new room only to the user who created it
+            await websocket.send(dumps({"type": "room_added", "room": await self.db.get_room(room_id)}))
+
+    async def on_search_rooms(self, websocket, nick, data):
+        query = data.get('query', '').strip()
+        if query:
+            results = await self.db.search_rooms(query, nick)
+            await websocket.send(dumps({"type": "search_results", "results": results}))
+
+    async def on_join_room(self, websocket, nick, data):
+        room_id = data.get('room_id')
+        # Вступить можно только в существующую группу: иначе в room_members
+        # попадёт мусор, а клиенту уйдёт room_added без комнаты
+        room = await self.db.get_room(room_id) if room_id else None
+        if room and await self.db.join_room(room_id, nick):
+            room["member_count"] += 1
+            self.role_cache.pop((room_id, nick), None)
+            self.room_members[room_id].add(nick)
+            # Send confirmation and the joined room; the client adds it to its list
+            await websocket.send(dumps({
+                "type": "room_joined",
+                "room_id": room_id,
+                "message": "Вы присоединились к группе"
+            }))
+            await websocket.send(dumps({"type": "room_added", "room": room}))
+        else:
+            await websocket.send(ERR_JOIN)
+
+    async def on_search_users(self, websocket, nick, data):
+        query = data.get('query', '').strip()
+        if query:
+            # Исключаем текущего пользователя из результатов
+            results = await self.db.search_users(query, exclude_username=nick)
+            await websocket.send(dumps({"type": "search_users_results", "results": results}))
+
+    async def on_get_recent_contacts(self, websocket, nick, data):
+        contacts = await self.db.get_recent_contacts(nick)
+        await websocket.send(dumps({"type": "recent_contacts", "contacts": contacts}))
+
+    async def on_rename_room(self, websocket, nick, data):
+        role = await self.user_role(data['room_name'], nick)
+        if role in ['admin']:
+            # Название экранируется, как и при создании группы
+            new_name = escape_html(data['new_name'][:ROOM_NAME_MAX_LEN])
+            await self.db.rename_room(data['room_name'], new_name)
+            await self.send_room_update(data['room_name'], name=new_name)
+
+    async def on_update_room_avatar(self, websocket, nick, data):
+        role = await self.user_role(data['room_name'], nick)
+        if role in ['admin']:
+            # Сохраняем аватар в БД
+            await self.db.update_room_avatar(data['room_name'], data['avatar'])
+            await self.send_room_update(data['room_name'], avatar=data['avatar'])
+
+    async def on_change_member_role(self, websocket, nick, data):
+        role = await self.user_role(data['room_name'], nick)
+        if role in ['admin']:
+            await self.db.change_member_role(data['room_name'], data['username'], data['role'])
+            self.role_cache.pop((data['room_name'], data['username']), None)
+            await self.broadcast_room(data['room_name'], {
+                "type": "info",
+                "text": f"Роль {data['username']} в группе {data['room_name']} изменена на {data['role']}"
+            })
+
+    async def on_history_req(self, websocket, nick, data):
+        context = data['context']
+        target = data['target']
+        if context == 'pm':
+            await self.db.mark_read(target, nick)
+            await self.send_to_user(target, {"type": "msgs_read_by_user", "reader": nick})
+        if context == 'room':
+            # История и сведения о группе (участники, закреп) читаются параллельно
+            hist, (room_info, pinned) = await asyncio.gather(
+                self.db.get_history(context, target, nick),
+                self.db.get_room_bundle(target),
+            )
+        else:
+            hist = await self.db.get_history(context, target, nick)
+            room_info = pinned = None
+        await websocket.send(dumps({
+            "type": "history", "history": hist, "context": context, "target": target, 
+            "room_info": room_info, "pinned": pinned
+        }))
 
 async def main(host, port):
-    server = ChatServer()
+    server = ChatServer(await AsyncDatabase.open(DB_NAME))
+    await server.load_room_members()
     print(f"🚀 NEOCHAT SERVER V10 ULTIMATE WebSocket running on {host}:{port}")
     
-    # Запускаем WebSocket сервер на выделенном PORT
-    # На локальной машине для HTTP файлов запустите отдельно:
-    # python -m http.server 5001 (в папке проекта)
+    # WebSocket и HTTP (клиент из STATIC_FILES, вложения) на одном PORT
+    flusher = asyncio.create_task(server.commit_flusher())
+    scheduler = asyncio.create_task(server.scheduler())
+    presence = asyncio.create_task(server.presence_worker())
     try:
-        async with websockets.serve(server.handler, host, port, max_size=MAX_MEDIA_SIZE):
+        async with websockets.serve(server.handler, host, port, max_size=MAX_MEDIA_SIZE,
+                                    process_request=server.process_request):
             print(f"✅ Server successfully started on ws://{host}:{port}")
             await asyncio.Future()
     except Exception as e:
         print(f"❌ Error starting server: {e}")
         raise
+    finally:
+        # Не теряем изменения последних миллисекунд при остановке
+        flusher.cancel()
+        scheduler.cancel()
+        presence.cancel()
+        await server.db.flush()
 
 if __name__ == "__main__":
     # Render выставляет PORT в переменную окружения
     port = int(os.environ.get("PORT", "5001"))
     print(f"🔧 Starting on port: {port}")
     print(f"📝 DATABASE: {DB_NAME}")
+    # uvloop.run создаёт цикл libuv сам, без политики цикла событий
+    run = asyncio.run if uvloop is None else uvloop.run
+    print(f"⚡ Event loop: {'asyncio' if uvloop is None else 'uvloop'}")
+    listener = setup_logging()
     try:
-        asyncio.run(main("0.0.0.0", port))
+        run(main("0.0.0.0", port))
     except KeyboardInterrupt:
         print("\n🛑 Server shutdown")
     except Exception as e:
         print(f"💥 Fatal error: {e}")
         import traceback
         traceback.print_exc()
+    finally:
+        listener.stop()